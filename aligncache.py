@@ -0,0 +1,197 @@
+"""
+aligncache.py - a persistent cache of aligned movesets
+
+The pokedex hardly ever changes, so there's no point aligning the same
+movesets on every request. Results are stored in a small SQLite database,
+keyed by what was asked for (an evolution chain or a list of pokemon, the
+version and the aligner) and checked against a fingerprint of the movesets,
+of pokemon.DATABASE and of the source of comparify, so entries go stale on
+their own when the pokedex or the aligners are updated.
+
+The cache holds at most MAX_ENTRIES results; the least recently used ones
+are thrown out first. When a result is used, its last use is only written
+back if it is more than TOUCH_INTERVAL seconds old, so most hits don't
+write to the database at all.
+
+If the cache can't be read or written (say, the web server's user can't
+write to DATABASE), time_align just aligns the movesets itself.
+
+Functions:
+    time_align - like comparify.time_align, but through the cache
+    warm - fill the cache ahead of time
+"""
+
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from time import time
+
+import comparify
+import pokemon
+
+DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'alignments.sqlite')
+
+MAX_ENTRIES = 20000
+TOUCH_INTERVAL = 3600
+
+# sqlite connections can't be shared between threads, so each thread gets
+# its own
+_local = threading.local()
+
+def _connect():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE, timeout=30)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS alignments (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                seconds REAL NOT NULL,
+                result TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS alignments_last_used
+            ON alignments (last_used)
+        """)
+        conn.commit()
+        _local.conn = conn
+    return conn
+
+def aligner_params(aligner_class):
+    """The settings of an aligner class, e.g. band or gap_penalty"""
+    params = {}
+    for cls in reversed(aligner_class.__mro__):
+        for name, value in vars(cls).items():
+            if name.startswith('_') or callable(value):
+                continue
+            if isinstance(value, (int, float, str, tuple, type(None))):
+                params[name] = value
+    return sorted(params.items())
+
+def make_key(subject, ver, aligner_class, dedupe=False):
+    """subject is e.g. ('evid', 1) or ('pokemon', [144, 145, 146])"""
+    key = [subject, ver, aligner_class.__name__, aligner_params(aligner_class)]
+    if dedupe:
+        key.append('dedupe')
+    return json.dumps(key)
+
+def database_stamp():
+    try:
+        st = os.stat(pokemon.DATABASE)
+    except OSError:
+        return None
+    return [pokemon.DATABASE, st.st_size, st.st_mtime]
+
+_code_stamp = None
+
+def code_stamp():
+    """A digest of the source of the aligners"""
+    global _code_stamp
+    if _code_stamp is None:
+        with open(comparify.__file__, 'rb') as f:
+            _code_stamp = hashlib.sha1(f.read()).hexdigest()
+    return _code_stamp
+
+def fingerprint(movesets):
+    data = json.dumps([database_stamp(), code_stamp(),
+                       [list(m) for m in movesets]])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def lookup(key, fp):
+    """Return (seconds, combined) from the cache, or None"""
+    try:
+        conn = _connect()
+        row = conn.execute("""
+            SELECT seconds, result, last_used FROM alignments
+            WHERE key = ? AND fingerprint = ?
+        """, [key, fp]).fetchone()
+        if row is None:
+            return None
+        seconds, result, last_used = row
+        now = time()
+        if TOUCH_INTERVAL < now - last_used:
+            conn.execute("UPDATE alignments SET last_used = ? WHERE key = ?",
+                         [now, key])
+            conn.commit()
+    except sqlite3.Error:
+        return None
+    combined = [[None if x is None else tuple(x) for x in r]
+                for r in json.loads(result)]
+    return seconds, combined
+
+def store(key, fp, seconds, combined):
+    """Store a result in the cache, if it can be written to"""
+    try:
+        _store(key, fp, seconds, combined)
+    except sqlite3.Error:
+        pass
+
+def _store(key, fp, seconds, combined):
+    conn = _connect()
+    conn.execute("""
+        INSERT OR REPLACE INTO alignments
+            (key, fingerprint, seconds, result, last_used)
+        VALUES (?, ?, ?, ?, ?)
+    """, [key, fp, seconds, json.dumps(combined), time()])
+    conn.execute("""
+        DELETE FROM alignments WHERE key IN (
+            SELECT key FROM alignments
+            ORDER BY last_used DESC
+            LIMIT -1 OFFSET ?
+        )
+    """, [MAX_ENTRIES])
+    conn.commit()
+
+def time_align(subject, ver, movesets,
+               aligner_class=comparify.HeuristicMoveAligner, memo=None,
+               dedupe=False):
+    """Align movesets, unless they are in the cache already.
+
+    Returns (seconds, combined), where seconds is how long the alignment
+    took when it was computed. memo and dedupe are passed on to
+    comparify.align."""
+    key = make_key(subject, ver, aligner_class, dedupe)
+    fp = fingerprint(movesets)
+    cached = lookup(key, fp)
+    if cached is not None:
+        return cached
+    seconds, combined = comparify.time_align(movesets, aligner_class, memo,
+                                             dedupe)
+    store(key, fp, seconds, combined)
+    return seconds, combined
+
+
+def warm(jobs, aligner_class=comparify.HeuristicMoveAligner, workers=None):
+    """Fill the cache in a pool of worker processes.
+
+    jobs is an iterable of (subject, ver, movesets). Jobs which are already
+    cached are skipped. Yields the subject and version of each job as it
+    is stored. Unlike time_align, this fails if the cache can't be written.
+    """
+    from concurrent import futures
+
+    executor = futures.ProcessPoolExecutor(workers)
+    try:
+        pending = {}
+        for subject, ver, movesets in jobs:
+            key = make_key(subject, ver, aligner_class)
+            fp = fingerprint(movesets)
+            if lookup(key, fp) is not None:
+                continue
+            packed = comparify.pack_movesets(movesets)
+            future = executor.submit(comparify.time_packed, packed,
+                                     aligner_class)
+            pending[future] = subject, ver, key, fp, packed[0]
+
+        for future in futures.as_completed(pending):
+            subject, ver, key, fp, names = pending.pop(future)
+            seconds, combined = future.result()
+            _store(key, fp, seconds, comparify.decode(combined, names))
+            yield subject, ver
+    finally:
+        executor.shutdown()
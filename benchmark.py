@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+benchmark.py - time the aligners on the real pokedex
+
+Every evolution chain in every version is aligned by each aligner class,
+a few times over, and the timings are summarised per chain and overall.
+Each aligner also gets one run per chain with comparify.profiler set, so
+the results include the time spent in each phase, the number of matches
+looked for (see comparify.Profiler) and the matrix sizes. The results can
+be saved as JSON and compared with an earlier run; the comparison fails
+(exit status 1) when an aligner got slower by more than the tolerance,
+used more memory, or produced a different table for some chain.
+
+Subsets:
+    all - every evolution chain in every version
+    troublesome - the chains of the pokemon listed in troublesome-pokemon
+
+Usage: benchmark.py [options], see --help
+"""
+
+import os
+import sys
+import json
+import hashlib
+import platform
+import argparse
+import tracemalloc
+from time import perf_counter
+
+import comparify
+import pokemon
+
+ALIGNERS = [
+    comparify.HeuristicMoveAligner,
+    comparify.HeuristicMoveAlignerRTL,
+    comparify.NeedlemanWunschMoveAligner,
+    comparify.DTWMoveAligner,
+]
+
+TROUBLESOME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'troublesome-pokemon')
+
+# The aggregate figures compared against a baseline; for each, larger is
+# worse
+COMPARED = ['p50', 'p90', 'total', 'peak_bytes']
+
+def troublesome_evids():
+    with open(TROUBLESOME) as f:
+        names = set(line.strip() for line in f if line.strip())
+    ids = [id for id, name in pokemon.all_pokemon() if name in names]
+    if len(ids) < len(names):
+        sys.stderr.write("warning: only %d of the %d troublesome pokemon "
+                         "are in the pokedex\n" % (len(ids), len(names)))
+    return sorted(set(pokemon.evid_from_pokemonid(id) for id in ids))
+
+def cases(subset='all', versions=None):
+    """Yield (name, movesets) for each chain and version in subset"""
+    if subset == 'all':
+        evids = pokemon.all_evids()
+    elif subset == 'troublesome':
+        evids = troublesome_evids()
+    else:
+        raise ValueError("unknown subset %r" % subset)
+    if versions is None:
+        versions = range(1, pokemon.LATEST_VERSION + 1)
+    for ver in versions:
+        for evid in evids:
+            moves = pokemon.moves_from_evid(evid, ver)
+            if not moves:
+                continue
+            _, movesets = zip(*moves)
+            yield "evid %d ver %d" % (evid, ver), movesets
+
+def percentile(values, p):
+    """The p-th percentile of values, by linear interpolation"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def digest(combined):
+    return hashlib.sha1(repr(combined).encode('utf-8')).hexdigest()
+
+def run_case(movesets, aligner_class, warmup, repeat):
+    """Time one alignment. Returns (seconds per run, peak bytes, digest)"""
+    for _ in range(warmup):
+        comparify.align(movesets, aligner_class)
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        combined = comparify.align(movesets, aligner_class)
+        times.append(perf_counter() - start)
+
+    # tracemalloc slows everything down, so memory gets a run of its own
+    tracemalloc.start()
+    try:
+        comparify.align(movesets, aligner_class)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, peak, digest(combined)
+
+def profile(movesets, aligner_class, profiler):
+    comparify.profiler = profiler
+    try:
+        comparify.align(movesets, aligner_class)
+    finally:
+        comparify.profiler = None
+
+def run(aligners, corpus, warmup=1, repeat=5, progress=None):
+    """Benchmark each of aligners on corpus, a list of (name, movesets)"""
+    results = {}
+    for aligner_class in aligners:
+        per_case = {}
+        profiler = comparify.Profiler()
+        for name, movesets in corpus:
+            times, peak, result = run_case(movesets, aligner_class,
+                                           warmup, repeat)
+            profile(movesets, aligner_class, profiler)
+            per_case[name] = {
+                'min': min(times),
+                'median': percentile(times, 50),
+                'max': max(times),
+                'peak_bytes': peak,
+                'moves': sum(len(m) for m in movesets),
+                'digest': result,
+            }
+        results[aligner_class.__name__] = {
+            'aggregate': aggregate(per_case),
+            'cases': per_case,
+            'profile': profiler.stats(),
+        }
+        if progress is not None:
+            progress(aligner_class.__name__, results[aligner_class.__name__])
+    return results
+
+def aggregate(per_case):
+    medians = [case['median'] for case in per_case.values()]
+    total = sum(medians)
+    moves = sum(case['moves'] for case in per_case.values())
+    return {
+        'cases': len(per_case),
+        'total': total,
+        'p50': percentile(medians, 50),
+        'p90': percentile(medians, 90),
+        'p99': percentile(medians, 99),
+        'max': max(medians) if medians else 0.0,
+        'cases_per_second': len(medians) / total if total else 0.0,
+        'moves_per_second': moves / total if total else 0.0,
+        'peak_bytes': max([case['peak_bytes']
+                           for case in per_case.values()] or [0]),
+    }
+
+def compare(baseline, results, tolerance):
+    """Compare results with baseline. Returns (report lines, failed)"""
+    lines = []
+    failed = False
+    for aligner, result in sorted(results.items()):
+        if aligner not in baseline:
+            lines.append("%s: not in the baseline" % aligner)
+            continue
+        old = baseline[aligner]
+        lines.append("%s:" % aligner)
+        for metric in COMPARED:
+            before = old['aggregate'][metric]
+            after = result['aggregate'][metric]
+            change = (after - before) / before if before else 0.0
+            worse = change > tolerance
+            failed = failed or worse
+            lines.append("  %-12s %14.6g -> %14.6g  %+7.1f%%%s" % (
+                metric, before, after, 100 * change,
+                "  REGRESSION" if worse else ""))
+
+        changed = sorted(name for name, case in result['cases'].items()
+                         if name in old['cases'] and
+                         old['cases'][name]['digest'] != case['digest'])
+        if changed:
+            failed = True
+            lines.append("  %d tables differ from the baseline:" %
+                         len(changed))
+            lines.extend("    " + name for name in changed)
+
+        slower = []
+        for name, case in result['cases'].items():
+            if name in old['cases'] and old['cases'][name]['median']:
+                ratio = case['median'] / old['cases'][name]['median']
+                if ratio > 1 + tolerance:
+                    slower.append((ratio, name))
+        if slower:
+            slower.sort(reverse=True)
+            lines.append("  slowest chains compared to the baseline:")
+            lines.extend("    %-20s %.2fx" % (name, ratio)
+                         for ratio, name in slower[:10])
+    return lines, failed
+
+def print_aggregate(name, result):
+    agg = result['aggregate']
+    print ("%-28s %4d chains  p50 %8.3f ms  p90 %8.3f ms  p99 %8.3f ms  "
+           "total %8.3f s  %8.1f chains/s  peak %6.1f KiB" % (
+               name, agg['cases'], 1000 * agg['p50'], 1000 * agg['p90'],
+               1000 * agg['p99'], agg['total'], agg['cases_per_second'],
+               agg['peak_bytes'] / 1024.0))
+
+def print_profile(name, result):
+    profile = result['profile']
+    for phase, stats in sorted(profile['phases'].items(),
+                               key=lambda x: -x[1]['seconds']):
+        print ("    %-30s %8d calls %10.3f ms" % (
+            phase, stats['calls'], 1000 * stats['seconds']))
+    for counter, n in sorted(profile['counters'].items()):
+        print ("    %-30s %8d" % (counter, n))
+    for value, stats in sorted(profile['values'].items()):
+        print ("    %-30s mean %10.1f  max %8d" % (
+            value, stats['total'] / float(stats['count']), stats['max']))
+
+def at_least(minimum):
+    """An argparse type for an int no less than minimum"""
+    def parse(value):
+        try:
+            n = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError("%r is not a number" % value)
+        if n < minimum:
+            raise argparse.ArgumentTypeError("must be at least %d" % minimum)
+        return n
+    return parse
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the aligners")
+    parser.add_argument('--subset', default='all',
+                        choices=['all', 'troublesome'])
+    parser.add_argument('--version', type=int, action='append',
+                        dest='versions',
+                        help="only this version (may be repeated)")
+    parser.add_argument('--aligner', action='append', dest='aligners',
+                        help="only this aligner class (may be repeated)")
+    parser.add_argument('--warmup', type=at_least(0), default=1)
+    parser.add_argument('--repeat', type=at_least(1), default=5)
+    parser.add_argument('--profile', action='store_true',
+                        help="print the time spent in each phase")
+    parser.add_argument('-o', '--output', help="save the results here")
+    parser.add_argument('--baseline', help="compare with these results")
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help="allowed slowdown, as a fraction "
+                             "(default 0.10)")
+    args = parser.parse_args(argv)
+
+    aligners = ALIGNERS
+    if args.aligners:
+        aligners = [getattr(comparify, name) for name in args.aligners]
+
+    pokemon.SNAPSHOT = True
+    corpus = list(cases(args.subset, args.versions))
+    def progress(name, result):
+        print_aggregate(name, result)
+        if args.profile:
+            print_profile(name, result)
+    results = run(aligners, corpus, args.warmup, args.repeat, progress)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'subset': args.subset,
+                    'versions': args.versions,
+                    'warmup': args.warmup,
+                    'repeat': args.repeat,
+                    'python': sys.version,
+                    'platform': platform.platform(),
+                },
+                'results': results,
+            }, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        lines, failed = compare(baseline, results, args.tolerance)
+        print ("\n".join(lines))
+        if failed:
+            print ("FAILED: regressions against %s" % args.baseline)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
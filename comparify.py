@@ -1,17 +1,37 @@
 """
 comparify.py - align pok\xe9mon movesets
 
-This module should be compatible with python 2.x >= 2.5 and python 3.x >= 3.0.
+This module needs python 3.x >= 3.2.
 
 Classes:
+    MoveNames - interns move names to small integers
+    Moveset - a moveset encoded as parallel arrays of levels and move ids
+    Row - a row of a Profile, indexed for fast matching
+    Table - the combined table built up by align(), stored by column
+    Profile - a combined table which knows which movesets its columns are
+
     MoveAligner - Base class for all the move aligners
 
     HeuristicMoveAligner - a heuristic algorithm developed by myself
     NeedlemanWunschMoveAligner - Needleman-Wunsch global sequence alignment
     DTWMoveAligner - dynamic time warping
+    ProfileMoveAligner - Needleman-Wunsch between two aligned tables
+
+    BandedMatrix - a sparse matrix for the banded mode of the aligners
+
+    AlignmentMemo - an in-process cache of partly aligned tables
+    Profiler - collects where the aligners spend their time
 
 Functions:
     align - align a list of movesets
+    collapse_runs, expand_runs - align runs of identical movesets once
+    align_tree - align movesets along a guide tree of their similarities
+    align_many - align many lists of movesets in worker processes
+    compare_aligners - time several aligners on the same movesets at once
+    encode - encode a moveset for the aligners
+    decode - decode an aligned table back to (level, move) pairs
+    pack_movesets, unpack_movesets - a compact, picklable form of movesets
+    time_packed - time the alignment of packed movesets, in a worker process
 
 
 Types of level-up move changes in evolution groups
@@ -49,20 +69,462 @@ Added attack at level of evolution
 # u - an upper bound
 # s - a set
 # m - move
+# x - an encoded move, see below
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+import functools
 
 try:
-    next
-except NameError:
-    def next(it):
-        return it.__next__()
+    from time import perf_counter as time
+except ImportError:
+    from time import time
 
 try:
-    range = xrange
-except NameError:
-    pass
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# The aligners don't work on (level, name) tuples directly. Move names are
+# interned to small integers and each moveset is stored as a pair of parallel
+# arrays. Inside an aligned table, a single move is packed into one int:
+#
+#   x = level << 16 | move id
+#
+# so comparing two moves by level, by move or by both is just a masked
+# integer comparison. Names are only looked up again when decoding the final
+# table.
+
+key_levels = 0xffff0000
+key_moves = 0x0000ffff
+key_both = 0xffffffff
+
+def level_of(x):
+    return x >> 16
+
+
+class MoveNames:
+    """Interns move names to small integers"""
+    def __init__(self, names=()):
+        self.names = []
+        self.ids = {}
+        for name in names:
+            self.intern(name)
+
+    def __repr__(self):
+        return "<%s %d names>" % (self.__class__.__name__, len(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, id):
+        return self.names[id]
+
+    def intern(self, name):
+        try:
+            return self.ids[name]
+        except KeyError:
+            id = self.ids[name] = len(self.names)
+            self.names.append(name)
+            return id
+
+move_names = MoveNames()
+
+
+class Moveset:
+    """A moveset encoded as parallel arrays of levels and move ids"""
+    def __init__(self, moves=(), names=move_names):
+        """
+        moves :: [(level, move)]
+        """
+        self.names = names
+        self.levels = array('H')
+        self.moves = array('H')
+        for level, move in moves:
+            self.levels.append(level)
+            self.moves.append(names.intern(move))
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, list(self))
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __getitem__(self, i):
+        return self.levels[i], self.names[self.moves[i]]
+
+    def __iter__(self):
+        names = self.names
+        for level, move in zip(self.levels, self.moves):
+            yield level, names[move]
+
+    def code(self, i):
+        return self.levels[i] << 16 | self.moves[i]
+
+    def codes(self):
+        return [level << 16 | move for level, move in zip(self.levels, self.moves)]
+
+
+class Row(list):
+    """A row of a Profile.
+
+    Besides the encoded moves, a row carries an index of the levels, moves and
+    (level, move) pairs it contains, so that MoveAligner.match is a set
+    lookup, and its first and last moves for lvalue.
+    """
+    keys = (key_both, key_moves, key_levels)
+
+    def __init__(self, moves=()):
+        list.__init__(self)
+        self.index = dict((key, set()) for key in self.keys)
+        self.first = self.last = None
+        for x in moves:
+            self.append(x)
+
+    def _index(self, x):
+        for key, s in self.index.items():
+            s.add(x & key)
+
+    def append(self, x):
+        list.append(self, x)
+        if x is not None:
+            self._index(x)
+            if self.first is None:
+                self.first = x
+            self.last = x
+
+
+class RowSummary:
+    """What the aligners need to know about a row of a Table: the same
+    index, first and last as a Row has, but not the moves themselves."""
+    __slots__ = ('index', 'first', 'last')
+
+    def __init__(self):
+        self.index = dict((key, set()) for key in Row.keys)
+        self.first = self.last = None
+
+    def copy(self):
+        summary = RowSummary()
+        summary.index = dict((key, set(s)) for key, s in self.index.items())
+        summary.first = self.first
+        summary.last = self.last
+        return summary
+
+    def add(self, x, front=False):
+        """Account for a move added at the end of the row, or the front"""
+        for key, s in self.index.items():
+            s.add(x & key)
+        if front or self.first is None:
+            self.first = x
+        if not front or self.last is None:
+            self.last = x
+
+class Table:
+    """The combined table, as the aligners build it up.
+
+    Rows have ids which never change; the table keeps the order of the row
+    ids, a RowSummary for each and, for each column, the codes of its moves
+    and the ids of the rows they are in. Indexing the table gives the
+    summary of a row, so it can be passed to the aligners as their left
+    side.
+
+    Adding a column (merge) takes time in the number of rows, whatever the
+    number of columns. rows() builds the actual table.
+
+    A copy shares the summaries with the table it was copied from, and
+    either one only copies a summary when it changes it, so copying a
+    table and adding a column to it takes time in the number of rows and
+    in the number of moves added, not in the size of the whole table.
+    """
+    def __init__(self):
+        self.order = [] # row ids, top to bottom
+        self.summaries = [] # row id -> RowSummary
+        self.columns = [] # (codes, row ids) for each column
+        self.owned = set() # row ids whose summary no copy shares
+
+    @classmethod
+    def from_moveset(cls, moveset):
+        table = cls()
+        table.merge([(None, i) for i in range(len(moveset))], moveset.codes())
+        return table
+
+    def __repr__(self):
+        return "<%s %d rows, %d columns>" % (
+            self.__class__.__name__, len(self.order), len(self.columns))
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        return self.summaries[self.order[i]]
+
+    def copy(self):
+        table = Table.__new__(Table)
+        table.order = list(self.order)
+        table.summaries = list(self.summaries)
+        # columns are never changed once added, so they can be shared
+        table.columns = list(self.columns)
+        # and from now on every summary is shared
+        table.owned = set()
+        self.owned = set()
+        return table
+
+    def merge(self, alignment, codes, front=False):
+        """Add a column of moves to the table, in place.
+
+        alignment is a list of (row index or None, move index or None)
+        pairs, giving the new order of the rows. The new column goes on the
+        end of the rows, or the front if front is true. Returns the table.
+        """
+        summaries = self.summaries
+        owned = self.owned
+        order = []
+        rowids = [None] * len(codes)
+        for iRow, iMove in alignment:
+            if iRow is None:
+                rowid = len(summaries)
+                summaries.append(RowSummary())
+                owned.add(rowid)
+            else:
+                rowid = self.order[iRow]
+            order.append(rowid)
+            if iMove is not None:
+                rowids[iMove] = rowid
+                if rowid not in owned:
+                    summaries[rowid] = summaries[rowid].copy()
+                    owned.add(rowid)
+                summaries[rowid].add(codes[iMove], front)
+        self.order = order
+        if front:
+            self.columns.insert(0, (codes, rowids))
+        else:
+            self.columns.append((codes, rowids))
+        return self
+
+    def rows(self):
+        """The encoded table, as a list of rows"""
+        position = {}
+        for i, rowid in enumerate(self.order):
+            position[rowid] = i
+        rows = [[None] * len(self.columns) for _ in self.order]
+        for iColumn, (codes, rowids) in enumerate(self.columns):
+            for x, rowid in zip(codes, rowids):
+                # a row can be left out of an alignment, and its moves
+                # with it
+                if rowid in position:
+                    rows[position[rowid]][iColumn] = x
+        return rows
+
+    def index_pairs(self, key):
+        """Every (row index, value) pair in the row indexes for key"""
+        rows = []
+        values = []
+        for i, rowid in enumerate(self.order):
+            for value in self.summaries[rowid].index[key]:
+                rows.append(i)
+                values.append(value)
+        return rows, values
+
+
+def encode(moveset, names=move_names):
+    """Encode a [(level, move)] list. Movesets are passed through."""
+    if isinstance(moveset, Moveset):
+        return moveset
+    return Moveset(moveset, names)
+
+def decode(table, names=move_names):
+    """Turn a table of encoded moves back into (level, move) pairs"""
+    if isinstance(table, Table):
+        table = table.rows()
+    return [[None if x is None else (x >> 16, names[x & 0xffff]) for x in row]
+            for row in table]
+
+
+# Traceback pointers: which neighbouring cell of a dynamic programming matrix
+# a cell's score was computed from. When there is a tie, the aligners prefer
+# them in this order.
+DIAG = 1 # (iLeft-1, iRight-1), the moves are aligned
+LEFT = 2 # (iLeft, iRight-1), a gap on the left
+UP = 3   # (iLeft-1, iRight), a gap on the right
+
+class Pointers:
+    """Traceback pointers for a dynamic programming matrix, one byte a cell.
+
+    bounds, if given, lists the (lo, hi) columns stored for each row, as in
+    BandedMatrix. first_row is the index of the first row stored.
+    """
+    def __init__(self, m, n, bounds=None, first_row=0):
+        if bounds is None:
+            bounds = [(0, n - 1)] * m
+        self.first_row = first_row
+        self.offsets = []
+        size = 0
+        for lo, hi in bounds:
+            self.offsets.append(size - lo)
+            size += hi - lo + 1
+        self.data = bytearray(size)
+
+    def __repr__(self):
+        return 'Pointers(%r)' % self.data
+
+    def __getitem__(self, ij):
+        i, j = ij
+        return self.data[self.offsets[i - self.first_row] + j]
+
+    def __setitem__(self, ij, v):
+        i, j = ij
+        self.data[self.offsets[i - self.first_row] + j] = v
+
+    def set_row(self, i, lo, row):
+        start = self.offsets[i - self.first_row] + lo
+        self.data[start:start + len(row)] = row
+
+
+# Profiling. Set profiler to a Profiler to have the aligners report to it.
+# While it is None, the only cost is one check per phase.
+
+profiler = None
+
+class Profiler:
+    """Collects timings and counts from the aligners.
+
+    For each phase (a method decorated with profiled), the number of calls
+    and the total wall time, inclusive of nested phases. For each alignment,
+    the size of its matrix (left rows times right moves) and the number of
+    matches looked for: calls to match(), or to first_match() for the
+    heuristic aligners, which find the matching row with an index. The
+    numpy engine of NeedlemanWunschMoveAligner matches every cell at once,
+    and counts the three matches similarity() would make for each. Aligners
+    may record other counts and values of their own.
+
+    Only alignments in this process are seen; align_many's workers don't
+    report to it. stats() returns everything as plain dicts.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.phases = {} # name -> [calls, seconds]
+        self.counters = {} # name -> count
+        self.values = {} # name -> [count, total, max]
+
+    def record(self, phase, seconds):
+        self.lock.acquire()
+        try:
+            entry = self.phases.setdefault(phase, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        finally:
+            self.lock.release()
+
+    def count(self, name, n=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + n
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value):
+        self.lock.acquire()
+        try:
+            entry = self.values.setdefault(name, [0, 0, value])
+            entry[0] += 1
+            entry[1] += value
+            entry[2] = max(entry[2], value)
+        finally:
+            self.lock.release()
+
+    def call(self, phase, method, aligner, args):
+        if callable(phase):
+            phase = phase(*args)
+        start = time()
+        try:
+            return method(aligner, *args)
+        finally:
+            self.record(phase, time() - start)
+
+    # the methods which look for a match, each call counted as one
+    counted = ('match', 'first_match')
+
+    def align(self, method, aligner):
+        """Run an aligner's align(), counting its calls to the counted
+        methods"""
+        self.observe('matrix_cells', len(aligner.left) * len(aligner.right))
+        counter = [0]
+        def counting(method):
+            def wrapper(*args, **kwargs):
+                counter[0] += 1
+                return method(*args, **kwargs)
+            return wrapper
+        wrapped = [name for name in self.counted if hasattr(aligner, name)]
+        for name in wrapped:
+            setattr(aligner, name, counting(getattr(aligner, name)))
+        try:
+            return self.call('align', method, aligner, ())
+        finally:
+            for name in wrapped:
+                delattr(aligner, name)
+            self.count('match', counter[0])
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            phases = dict((name, {'calls': calls, 'seconds': seconds})
+                          for name, (calls, seconds) in self.phases.items())
+            values = dict((name, {'count': n, 'total': total, 'max': max_})
+                          for name, (n, total, max_) in self.values.items())
+            return {'phases': phases, 'counters': dict(self.counters),
+                    'values': values}
+        finally:
+            self.lock.release()
+
+    def report(self):
+        """The stats as a table, slowest phase first"""
+        stats = self.stats()
+        lines = []
+        phases = sorted(stats['phases'].items(),
+                        key=lambda x: -x[1]['seconds'])
+        for name, phase in phases:
+            lines.append("%-28s %8d calls %12.6f s" % (
+                name, phase['calls'], phase['seconds']))
+        for name, n in sorted(stats['counters'].items()):
+            lines.append("%-28s %8d" % (name, n))
+        for name, value in sorted(stats['values'].items()):
+            lines.append("%-28s %8d times, total %d, max %d" % (
+                name, value['count'], value['total'], value['max']))
+        return "\n".join(lines)
+
+def profiled(phase=None):
+    """Decorator: report calls of an aligner method to the profiler.
+
+    phase is the name to report them under, or a function which returns it
+    given the method's arguments. It defaults to the name of the method."""
+    def decorate(method):
+        name = phase or method.__name__
+        def wrapper(self, *args):
+            if profiler is None:
+                return method(self, *args)
+            return profiler.call(name, method, self, args)
+        return functools.wraps(method)(wrapper)
+    return decorate
+
+def profiled_align(method):
+    """Decorator for align(): reports it as a phase, with its match count"""
+    def align(self):
+        if profiler is None:
+            return method(self)
+        return profiler.align(method, self)
+    return functools.wraps(method)(align)
+
+_key_names = {key_both: 'both', key_moves: 'moves', key_levels: 'levels'}
+
+def _lock_phase(key):
+    return 'lock_' + _key_names.get(key, hex(key))
 
-# No effect in py3
-__metaclass__ = type
 
 class MoveAligner:
     style = 'LTR'
@@ -70,26 +532,19 @@ class MoveAligner:
     def __repr__(self):
         return "<%s %r>" % (self.__class__.__name__, vars(self))
 
-    def match(self, iLeft, iRight, key=lambda x: x, reverse=True):
-        needle = key(self.right[iRight])
-        haystack = self.left[iLeft]
-        if reverse:
-            haystack = reversed(haystack)
-        for x in haystack:
-            if x is None:
-                continue
-            if needle == key(x):
-                return True
-        return False
+    def match(self, iLeft, iRight, key=key_both):
+        return self.right.code(iRight) & key in self.left[iLeft].index[key]
 
     def lvalue(self, iLeft):
-        for m in reversed(self.left[iLeft]):
-            if m is not None:
-                return m
+        return self.left[iLeft].last
 
-    def sort_levels(self):
-        alignment = self.alignment
-        left = self.left
+    # The passes after an alignment is found (fill_gaps, sort_levels) each
+    # read the alignment once, from front to back, and yield a new one. They
+    # only ever hold back a run of gaps, so they can be chained into a
+    # single pass (see postprocess) with no list built in between.
+
+    def sorting_levels(self, alignment):
+        """Yield alignment with each run of gaps sorted by level"""
         right = self.right
 
         def key(x):
@@ -97,126 +552,190 @@ class MoveAligner:
             if None not in x:
                 raise ValueError(x)
             if l is not None:
-                return key_levels(self.lvalue(l))
+                return level_of(self.lvalue(l))
             elif r is not None:
-                return key_levels(right[r])
+                return right.levels[r]
             raise ValueError
 
-        i = 0
-        li = 0
-        while i < len(alignment):
-            if None not in alignment[i]:
-                li = i + 1
-                i += 1
+        run = []
+        for x in alignment:
+            if None in x:
+                run.append(x)
+                continue
+            if 1 < len(run):
+                run.sort(key=key)
+            for y in run:
+                yield y
+            run = []
+            yield x
+        if 1 < len(run):
+            run.sort(key=key)
+        for y in run:
+            yield y
+
+    @profiled()
+    def sort_levels(self):
+        self.alignment = list(self.sorting_levels(self.alignment))
+
+    def filling_gaps(self, alignment, side, start=0):
+        """Yield alignment with gaps on one side filled in.
+
+        A run of entries with nothing on side (0 for the left, 1 for the
+        right) followed by a run of the same length with nothing on the
+        other side is merged into a run of pairs. The first start entries
+        are passed through as they are."""
+        other = 1 - side
+        gaps = [] # a run of entries with nothing on side
+        fills = [] # and the run after it, with nothing on the other side
+        for iAlignment, x in enumerate(alignment):
+            if iAlignment < start:
+                yield x
                 continue
-            ui = len(alignment)
-            for j in range(li, ui):
-                if None not in alignment[j]:
-                    ui = j
-                    break
-            if li < ui and 1 < (ui - li):
-                alignment[li:ui] = sorted(alignment[li:ui], key=key)
-                i = ui
+            if fills:
+                if x[other] is None:
+                    fills.append(x)
+                    continue
+                for y in self._merge_gap(gaps, fills, side):
+                    yield y
+                gaps = []
+                fills = []
+
+            if x[side] is None:
+                assert x[other] is not None
+                gaps.append(x)
+            elif gaps and x[other] is None:
+                fills.append(x)
             else:
-                i += 1
+                for y in gaps:
+                    yield y
+                gaps = []
+                yield x
+        for y in self._merge_gap(gaps, fills, side):
+            yield y
+
+    def _merge_gap(self, gaps, fills, side):
+        if len(gaps) != len(fills):
+            return gaps + fills
+        if side == 1:
+            return [(g[0], f[1]) for g, f in zip(gaps, fills)]
+        else:
+            return [(f[0], g[1]) for g, f in zip(gaps, fills)]
 
-    def _merge_gap_left(self, iRight, cGap):
-        alignment = self.alignment
-        for i in range(iRight, iRight + cGap):
-            alignment[i] = alignment[i][0], alignment[i+cGap][1]
+    def fill_gaps_left(self):
+        self.alignment = list(self.filling_gaps(self.alignment, 1))
 
-        del alignment[iRight+cGap:iRight+cGap+cGap]
+    def fill_gaps_right(self):
+        self.alignment = list(self.filling_gaps(self.alignment, 0,
+                                                min(self.skip_lv1())))
 
-    def fill_gaps_left(self):
-        alignment = self.alignment
-        left = self.left
-        right = self.right
+    def filling_all_gaps(self, alignment):
+        """fill_gaps_left then fill_gaps_right, as one pass"""
+        return self.filling_gaps(self.filling_gaps(alignment, 1),
+                                 0, min(self.skip_lv1()))
 
-        cGapRight = 0
-        iAlignmentRight = 0
-        while iAlignmentRight < len(alignment):
-            if alignment[iAlignmentRight][1] is None:
-                assert alignment[iAlignmentRight][0] is not None
-                cGapRight += 1
-            elif cGapRight:
-                cGapLeft = 0
-                for iAlignmentLeft in range(iAlignmentRight, len(alignment)):
-                    if alignment[iAlignmentLeft][0] is None:
-                        cGapLeft += 1
-                    else:
-                        break
-                if cGapLeft == cGapRight:
-                    assert cGapLeft != 0
-                    self._merge_gap_left(iAlignmentRight - cGapRight, cGapRight)
-                    iAlignmentRight -= 1
-                cGapRight = 0
-            iAlignmentRight += 1
-
-    def _merge_gap_right(self, iLeft, cGap):
-        alignment = self.alignment
-        for i in range(iLeft, iLeft + cGap):
-            alignment[i] = alignment[i+cGap][0], alignment[i][1]
+    @profiled()
+    def fill_gaps(self):
+        self.alignment = list(self.filling_all_gaps(self.alignment))
+
+    def postprocess(self):
+        """fill_gaps then sort_levels, as one pass.
+
+        While profiling, the two are run one after the other instead, so
+        each gets its phase as it does for the heuristic aligners."""
+        if profiler is not None:
+            self.fill_gaps()
+            self.sort_levels()
+            return
+        self.alignment = list(
+            self.sorting_levels(self.filling_all_gaps(self.alignment)))
+
+    @profiled()
+    def compute_banded(self):
+        """Compute the alignment only looking at a band around the diagonal.
+
+        Movesets are sorted by level, so a good alignment stays close to the
+        diagonal of the matrix. Only cells within self.band columns of it are
+        computed and stored (see banded_matrix). The band is doubled and the
+        matrix computed again until band_is_exact says that no path through
+        a cell outside the band could do as well as the banded alignment, or
+        the band covers the whole matrix. Either way, the alignment is the
+        one the full computation gives.
+        """
+        width = self.band
+        while True:
+            if profiler is not None:
+                profiler.observe('band_width', width)
+            self.matrix = self.banded_matrix(width)
+            self.pointers = Pointers(len(self.left), len(self.right),
+                                     self.matrix.bounds)
+            self.compute_matrix()
+            self.compute_alignment()
+            if self.matrix.is_full() or self.band_is_exact():
+                break
+            width = max(2 * width, 1)
 
-        del alignment[iLeft+cGap:iLeft+cGap+cGap]
+    @profiled()
+    def compute_alignment(self):
+        """Compute the alignment by following self.pointers from the end"""
+        alignment = []
+        iLeft, iRight = self.follow_pointers(self.pointers,
+                                             len(self.left)-1, len(self.right)-1,
+                                             alignment)
+        self.finish_alignment(alignment, iLeft, iRight)
+
+    def follow_pointers(self, pointers, iLeft, iRight, alignment, lo=0):
+        """Append the traceback from (iLeft, iRight) to alignment, in reverse.
+
+        Stops at the edge of the matrix, or when it leaves row lo, and returns
+        where it stopped."""
+        while lo <= iLeft and 0 <= iRight:
+            pointer = pointers[iLeft, iRight]
+            if pointer == DIAG:
+                alignment.append((iLeft, iRight))
+                iLeft, iRight = iLeft-1, iRight-1
+            elif pointer == LEFT:
+                alignment.append((None, iRight))
+                iRight -= 1
+            elif pointer == UP:
+                alignment.append((iLeft, None))
+                iLeft -= 1
+            else:
+                raise Exception((iLeft, iRight))
+        return iLeft, iRight
 
-    def fill_gaps_right(self):
-        alignment = self.alignment
-        left = self.left
-        right = self.right
+    def finish_alignment(self, alignment, iLeft, iRight):
+        """Add what is left over after a traceback, and store the alignment"""
+        while 0 <= iRight:
+            alignment.append((None,iRight))
+            iRight -= 1
 
-        cGapLeft = 0
-        iAlignmentLeft = min(self.skip_lv1())
-        while iAlignmentLeft < len(alignment):
-            if alignment[iAlignmentLeft][0] is None:
-                assert alignment[iAlignmentLeft][1] is not None
-                cGapLeft += 1
-            elif cGapLeft:
-                cGapRight = 0
-                for iAlignmentRight in range(iAlignmentLeft, len(alignment)):
-                    if alignment[iAlignmentRight][1] is None:
-                        cGapRight += 1
-                    else:
-                        break
-                if cGapLeft == cGapRight:
-                    assert cGapLeft != 0
-                    self._merge_gap_right(iAlignmentLeft - cGapLeft, cGapLeft)
-                    iAlignmentLeft -= 1
-                cGapLeft = 0
-            iAlignmentLeft += 1
+        while 0 <= iLeft:
+            alignment.append((iLeft,None))
+            iLeft -= 1
 
-    def fill_gaps(self):
-        self.fill_gaps_left()
-        self.fill_gaps_right()
+        alignment.reverse()
+        self.alignment = alignment
 
+    @profiled()
     def apply_alignment(self):
-        left = self.left
-        right = self.right
-        final = []
-
-        cms = len(left[0])
-        for iLeft, iRight in self.alignment:
-            if iLeft is None:
-                final.append([None] * cms + [right[iRight]])
-            elif iRight is None:
-                final.append(left[iLeft] + [None])
-            else:
-                final.append(left[iLeft] + [right[iRight]])
+        """Add the right moveset to the combined Table, following the
+        alignment. The table is changed in place, and returned.
 
-        return final
+        The moves stay encoded; pass the result through decode() to get the
+        names back."""
+        return self.left.merge(self.alignment, self.right.codes())
 
     def skip_lv1(self):
         iLeft = iRight = 0
+        lv1 = 1 << 16
         for iLeft in range(len(self.left)):
-            if any(key_levels(x) == 1 for x in self.left[iLeft] if x is not None):
+            if lv1 in self.left[iLeft].index[key_levels]:
                 break
         for iRight in range(len(self.right)):
-            if key_levels(self.right[iRight]) == 1:
+            if self.right.levels[iRight] == 1:
                 break
         return iLeft, iRight
 
-key_levels = lambda x: x[0]
-key_moves = lambda x: x[1]
-
 class HeuristicMoveAligner(MoveAligner):
     """
     A heuristic approach to pok\xe9mon move alignment.
@@ -238,49 +757,97 @@ class HeuristicMoveAligner(MoveAligner):
     moves.
 
     Pass 5 does a sort so that levels are more or less in order.
+
+    Both orders of passes 2 and 3 start from what pass 1 locked, which is
+    kept in self.alignment; the locks each order makes on top of it are kept
+    in self.locked until fill_alignment builds the full alignment. The
+    candidate rows for a move are looked up in an index of the rows by
+    value (see positions) instead of trying each row in turn. The shorter
+    alignment wins, movesfirst on a tie, so levelsfirst isn't tried at all
+    when movesfirst is already as short as an alignment can be.
     """
     def __init__(self, left, right):
         """
-        left :: [[(level, move)]]
-        right :: [(level, move)]
+        left :: [Row]
+        right :: Moveset
         """
         self.left = left
         self.right = right
 
     def clear(self):
         self.alignment = [] # :: [(Maybe i, j)]
+        self.locked = {} # alignment index -> i
+        self._positions = {}
+        self._codes = self.right.codes()
 
+    @profiled_align
     def align(self):
         self.clear()
 
         self.lock_both()
+        base = self.alignment
 
+        self.lock_passes(base, (key_moves, key_levels))
         movesfirst = self.alignment
-        levelsfirst = list(self.alignment)
-
-        self.lock(key_moves)
-        self.lock(key_levels)
-        self.fill_alignment()
-        self.fill_gaps()
+        self.strategy = 'movesfirst'
 
-        self.alignment = levelsfirst
-        self.lock(key_levels)
-        self.lock(key_moves)
-        self.fill_alignment()
-        self.fill_gaps()
-
-        if len(levelsfirst) < len(movesfirst):
-            self.alignment = levelsfirst
-            self.strategy = 'levelsfirst'
-        else:
-            self.alignment = movesfirst
-            self.strategy = 'movesfirst'
-        print (self.strategy)
+        if self.shortest() < len(movesfirst):
+            self.lock_passes(base, (key_levels, key_moves))
+            if len(self.alignment) < len(movesfirst):
+                self.strategy = 'levelsfirst'
+            else:
+                self.alignment = movesfirst
+        elif profiler is not None:
+            profiler.count('strategy_skipped')
+        if profiler is not None:
+            profiler.count('strategy_' + self.strategy)
 
         self.sort_levels()
 
         return self.apply_alignment()
 
+    def lock_passes(self, base, keys):
+        """Lock on each of keys in turn, on top of the alignment base from
+        lock_both, and fill in the rest. base itself isn't changed."""
+        self.alignment = base
+        self.locked = {}
+        for key in keys:
+            self.lock(key)
+        self.fill_alignment()
+        self.fill_gaps()
+
+    def shortest(self):
+        """A lower bound on the length of any alignment lock_passes can give.
+
+        Every move is in the alignment and every row but (at most) one, each
+        of them once."""
+        return max(len(self.left) - 1, len(self.right))
+
+    def positions(self, key):
+        """For each value of key among the moves being aligned, the indices
+        of the rows which have it, in ascending order"""
+        positions = self._positions.get(key)
+        if positions is None:
+            positions = self._positions[key] = {}
+            for x in self._codes:
+                positions[x & key] = []
+            left = self.left
+            for iLeft in range(len(left)):
+                for value in left[iLeft].index[key]:
+                    aiLeft = positions.get(value)
+                    if aiLeft is not None:
+                        aiLeft.append(iLeft)
+        return positions
+
+    def first_match(self, iRight, key, liLeft, uiLeft):
+        """The first row in liLeft:uiLeft which matches move iRight on key,
+        or None"""
+        aiLeft = self.positions(key)[self._codes[iRight] & key]
+        i = bisect_left(aiLeft, liLeft)
+        if i < len(aiLeft) and aiLeft[i] < uiLeft:
+            return aiLeft[i]
+        return None
+
     # XXX unused
     def lower_bounds(self):
         ali = []
@@ -293,18 +860,7 @@ class HeuristicMoveAligner(MoveAligner):
                 ali.append(None)
         return ali
 
-    def upper_bounds(self, max):
-        aui = []
-        ui = max
-        for i, _ in reversed(self.alignment):
-            if i is None:
-                aui.append(ui)
-            else:
-                ui = i
-                aui.append(None)
-        aui.reverse()
-        return aui
-
+    @profiled()
     def lock_both(self):
         """locks when both the levels and moves match.
 
@@ -314,37 +870,42 @@ class HeuristicMoveAligner(MoveAligner):
         liLeft = 0
         cLeft = len(self.left)
         for iRight in range(len(self.right)):
-            for iLeft in range(liLeft, cLeft):
-                if self.match(iLeft, iRight):
-                    alignment.append((iLeft, iRight))
-                    liLeft = iLeft + 1
-                    break
-            else:
-                alignment.append((None, iRight))
-
-        for iRight in range(iRight + 1, len(self.right)):
-            alignment.append((None, iRight))
+            iLeft = self.first_match(iRight, key_both, liLeft, cLeft)
+            alignment.append((iLeft, iRight))
+            if iLeft is not None:
+                liLeft = iLeft + 1
 
+    @profiled(_lock_phase)
     def lock(self, key):
+        """locks each move which isn't locked yet to the first row which
+        matches on key, between the rows locked before and after it."""
         alignment = self.alignment
-        left = self.left
-        right = self.right
-        bounds = self.upper_bounds(len(left))
+        locked = self.locked
+        cLeft = len(self.left)
 
         liLeft = 0
-        for iAlignment, ((iLeft, iRight), uiLeft) \
-            in enumerate(zip(alignment, bounds)):
+        uiLeft = None # the bound for this run of unlocked moves
+        for iAlignment, (iLeft, iRight) in enumerate(alignment):
+            iLeft = locked.get(iAlignment, iLeft)
             if iLeft is not None:
                 liLeft = iLeft + 1
+                uiLeft = None
                 continue
 
-            for iLeft in range(liLeft,  uiLeft):
-                if self.match(iLeft, iRight, key=key):
-                    alignment[iAlignment] = (iLeft, iRight)
-                    liLeft = iLeft + 1
-                    break
+            if uiLeft is None:
+                # locking a move in the run can't change the bound of the
+                # moves after it, as they are all before the next lock
+                uiLeft = cLeft
+                for iNext in range(iAlignment + 1, len(alignment)):
+                    iNextLeft = locked.get(iNext, alignment[iNext][0])
+                    if iNextLeft is not None:
+                        uiLeft = iNextLeft
+                        break
 
-        return
+            iLeft = self.first_match(iRight, key, liLeft, uiLeft)
+            if iLeft is not None:
+                locked[iAlignment] = iLeft
+                liLeft = iLeft + 1
 
     def lock_while(self, left, right, liLeft, liRight, key):
         """locks while the left and right are equal or already locked"""
@@ -364,13 +925,18 @@ class HeuristicMoveAligner(MoveAligner):
 
         return
 
+    @profiled()
     def fill_alignment(self):
         left = self.left
         right = self.right
+        alignment = self.alignment
+        locked = self.locked
 
         uiLeft = len(left)-1
         newalignment = []
-        for iLeft, iRight in reversed(self.alignment):
+        for iAlignment in range(len(alignment) - 1, -1, -1):
+            iLeft, iRight = alignment[iAlignment]
+            iLeft = locked.get(iAlignment, iLeft)
             if iLeft is None:
                 newalignment.append((None, iRight))
             else:
@@ -383,30 +949,34 @@ class HeuristicMoveAligner(MoveAligner):
             newalignment.append((iLeft, None))
 
         newalignment.reverse()
-        self.alignment[:] = newalignment
+        self.alignment = newalignment
+        self.locked = {}
 
 
 class HeuristicMoveAlignerRTL(HeuristicMoveAligner):
     style = 'RTL'
     def __init__(self, left, right):
         """
-        left :: [(level, move)]
-        right :: [[(level, move)]]
+        left :: Moveset
+        right :: [Row]
         """
         self.left = right
         self.right = left
 
-    def fill_gaps(self):
-        self.fill_gaps_right()
-        self.fill_gaps_left()
+    def filling_all_gaps(self, alignment):
+        return self.filling_gaps(self.filling_gaps(alignment, 0,
+                                                   min(self.skip_lv1())), 1)
 
+    @profiled()
     def fill_alignment(self):
         left = self.left
         right = self.right
+        locked = self.locked
 
         liLeft = 0
         newalignment = []
-        for iLeft, iRight in self.alignment:
+        for iAlignment, (iLeft, iRight) in enumerate(self.alignment):
+            iLeft = locked.get(iAlignment, iLeft)
             if iLeft is None:
                 newalignment.append((None, iRight))
             else:
@@ -418,28 +988,21 @@ class HeuristicMoveAlignerRTL(HeuristicMoveAligner):
         for iLeft in range(liLeft, len(left)):
             newalignment.append((iLeft, None))
 
-        self.alignment[:] = newalignment
-
-    def apply_alignment(self):
-        left = self.right
-        right = self.left
-        final = []
+        self.alignment = newalignment
+        self.locked = {}
 
-        cm = len(right[0])
-        for iRight, iLeft in self.alignment:
-            if iLeft is None:
-                final.append([None] + right[iRight])
-            elif iRight is None:
-                final.append([left[iLeft]] + [None]*cm)
-            else:
-                final.append([left[iLeft]] + right[iRight])
+    def shortest(self):
+        # fill_alignment keeps every row
+        return max(len(self.left), len(self.right))
 
-        return final
+    @profiled()
+    def apply_alignment(self):
+        # the combined table is on the right, but self.left is the table
+        # and the alignment pairs are (table row, move) all the same
+        return self.left.merge(self.alignment, self.right.codes(), front=True)
 
     def lvalue(self, iLeft):
-        for m in self.left[iLeft]:
-            if m is not None:
-                return m
+        return self.left[iLeft].first
 
 
 class NeedlemanWunschMoveAligner(MoveAligner):
@@ -448,9 +1011,32 @@ class NeedlemanWunschMoveAligner(MoveAligner):
 
     http://en.wikipedia.org/wiki/Needleman-Wunsch_algorithm
 
+    If numpy is installed, the matrix is filled by a vectorized engine (see
+    compute_matrix_numpy) which gives exactly the same alignment. Set
+    use_numpy to False to force the pure-python code.
+
+    When the matrix would have more than hirschberg_threshold cells, the
+    alignment is computed in a divide-and-conquer mode which only keeps a
+    few rows of the matrix in memory (see compute_alignment_hirschberg).
+    Set the threshold to None to never use it. It stops splitting at blocks
+    of hirschberg_block cells, whose traceback pointers it keeps at a byte
+    a cell (64 KiB for the default).
+
+    Setting band to a number turns on the banded mode (see compute_banded),
+    which takes precedence over the other engines.
+
+    The engines record a traceback pointer for each cell while filling the
+    matrix, and only keep the last row or two of scores. Set keep_matrix to
+    keep all of them in self.matrix, e.g. to print it.
     """
     zero = (0, 0, 0)
     gap_penalty = (0, 0, 1)
+    outside = (float('-inf'), 0, 0)
+    use_numpy = True
+    hirschberg_threshold = 1000000
+    hirschberg_block = 65536
+    band = None
+    keep_matrix = False
 
     def __init__(self, left, right):
         self.left = left
@@ -458,20 +1044,53 @@ class NeedlemanWunschMoveAligner(MoveAligner):
 
     def clear(self):
         self.alignment = []
-        self.matrix = NeedlemanWunschMatrix(len(self.left), len(self.right),
-                                            default=self.zero)
-
+        self.matrix = None
+        self.pointers = None
+        self.engine = self.choose_engine()
+        if self.engine == 'python':
+            cLeft, cRight = len(self.left), len(self.right)
+            self.matrix = NeedlemanWunschMatrix(cLeft, cRight,
+                                                default=self.zero,
+                                                rolling=not self.keep_matrix)
+            self.pointers = Pointers(cLeft, cRight)
+
+    def numpy_enabled(self):
+        return self.use_numpy and numpy is not None
+
+    def choose_engine(self):
+        if self.band is not None:
+            return 'banded'
+        cells = len(self.left) * len(self.right)
+        if (self.hirschberg_threshold is not None
+            and self.hirschberg_threshold < cells):
+            return 'hirschberg'
+        if self.numpy_enabled():
+            return 'numpy'
+        return 'python'
+
+    @profiled_align
     def align(self):
         self.clear()
 
-        self.compute_matrix()
-        self.compute_alignment()
+        if self.engine == 'banded':
+            self.compute_banded()
+        elif self.engine == 'hirschberg':
+            self.compute_alignment_hirschberg()
+        elif self.engine == 'numpy':
+            self.compute_matrix_numpy()
+            self.compute_alignment()
+        else:
+            self.compute_matrix()
+            self.compute_alignment()
 
-        self.fill_gaps()
-        self.sort_levels()
+        self.postprocess()
 
         return self.apply_alignment()
 
+    def banded_matrix(self, width):
+        return BandedMatrix(len(self.left), len(self.right), width,
+                            outside=self.outside, border=self.zero)
+
     def similarity(self, iLeft, iRight):
         return (
             int(self.match(iLeft, iRight)),
@@ -483,60 +1102,254 @@ class NeedlemanWunschMoveAligner(MoveAligner):
     def add(self, a, b):
         return tuple(m + n for m, n in zip(a, b))
 
+    def index_sets(self, key):
+        """The values of key in each row on the left, and each move on the
+        right"""
+        left = [self.left[iLeft].index[key] for iLeft in range(len(self.left))]
+        right = [set([x & key]) for x in self.right.codes()]
+        return left, right
+
+    def similarity_bounds(self):
+        """The most similarity() can give for each row, and for each move"""
+        found = []
+        for key in (key_both, key_moves, key_levels):
+            left, right = self.index_sets(key)
+            sLeft = set()
+            for s in left:
+                sLeft.update(s)
+            sRight = set()
+            for s in right:
+                sRight.update(s)
+            found.append(([int(not s.isdisjoint(sRight)) for s in left],
+                          [int(not s.isdisjoint(sLeft)) for s in right]))
+        (bothLeft, bothRight), (movesLeft, movesRight), \
+            (levelsLeft, levelsRight) = found
+        rows = [(a, 2 * b + c, 0)
+                for a, b, c in zip(bothLeft, movesLeft, levelsLeft)]
+        columns = [(a, 2 * b + c, 0)
+                   for a, b, c in zip(bothRight, movesRight, levelsRight)]
+        return rows, columns
+
+    def band_is_exact(self):
+        """Whether the full matrix would give the banded alignment too.
+
+        It does if every path through a cell outside the band scores less
+        than the banded alignment, as then all the cells the traceback
+        compares are the same in both. A path aligns each row and each move
+        at most once, so its similarity is at most the sum of the bounds of
+        the rows it crosses, and of the moves; and it has at most one gap
+        per row and move."""
+        cLeft, cRight = len(self.left), len(self.right)
+        score = self.matrix[cLeft-1, cRight-1]
+        rows, columns = self.similarity_bounds()
+        aRows = running_sums(rows, (0, 0, 0), self.add)
+        aColumns = running_sums(columns, (0, 0, 0), self.add)
+        gaps = tuple(max(x, 0) * (cLeft + cRight) for x in self.gap_penalty)
+        start = self.add(self.zero, gaps)
+        def least(a, b):
+            return tuple(map(min, a, b))
+        def rest(sums, i):
+            return tuple(a - b for a, b in zip(sums[-1], sums[i]))
+        for iLeft, iRight in self.matrix.exits():
+            before = least(aRows[iLeft+1], aColumns[iRight+1])
+            after = least(rest(aRows, iLeft+1), rest(aColumns, iRight+1))
+            if not self.add(start, self.add(before, after)) < score:
+                return False
+        return True
+
+    @profiled()
     def compute_matrix(self):
         m = self.matrix
+        pointers = self.pointers
+        add = self.add
+        gap = self.gap_penalty
         for iLeft in range(len(self.left)):
-            for iRight in range(len(self.right)):
-                m[iLeft,iRight] = max(
-                    self.add(m[iLeft-1,iRight-1],
-                             self.similarity(iLeft, iRight)),
-                    self.add(m[iLeft-1,iRight],
-                             self.gap_penalty),
-                    self.add(m[iLeft,iRight-1],
-                             self.gap_penalty),
-                )
-
-    def compute_alignment(self):
-        matrix = self.matrix
-
+            for iRight in m.columns(iLeft):
+                fromdiag = add(m[iLeft-1,iRight-1],
+                               self.similarity(iLeft, iRight))
+                fromleft = add(m[iLeft,iRight-1], gap)
+                fromup = add(m[iLeft-1,iRight], gap)
+                score = max(fromdiag, fromleft, fromup)
+                m[iLeft,iRight] = score
+                pointers[iLeft,iRight] = (DIAG if score == fromdiag else
+                                          LEFT if score == fromleft else UP)
+
+    def compute_row(self, prev, iLeft):
+        """Compute row iLeft of the matrix, given row iLeft-1.
+
+        Returns the scores and the traceback pointers of the row."""
+        add = self.add
+        gap = self.gap_penalty
+        row = []
+        pointers = bytearray(len(self.right))
+        score = diag = self.zero
+        for iRight in range(len(self.right)):
+            fromdiag = add(diag, self.similarity(iLeft, iRight))
+            fromleft = add(score, gap)
+            fromup = add(prev[iRight], gap)
+            score = max(fromdiag, fromleft, fromup)
+            pointers[iRight] = (DIAG if score == fromdiag else
+                                LEFT if score == fromleft else UP)
+            row.append(score)
+            diag = prev[iRight]
+        return row, pointers
+
+    @profiled()
+    def compute_alignment_hirschberg(self):
+        """Compute the alignment without storing the whole matrix.
+
+        Like Hirschberg's algorithm, this splits the rows in half and
+        recurses, recomputing matrix rows as it needs them. Hirschberg's
+        algorithm chooses the split point from forward and reverse scores,
+        though, and among equally good alignments it may pick a different one
+        than compute_alignment does. Instead, the traceback is run through
+        the lower half first, which tells us exactly where it enters the
+        upper half.
+
+        Memory is O(n log m) for an m by n matrix, time O(mn log m).
+        """
         iLeft, iRight = len(self.left)-1, len(self.right)-1
         alignment = []
-        while 0 <= iLeft and 0 <= iRight:
-            score = matrix[iLeft, iRight]
-            if score == self.add(matrix[iLeft-1,iRight-1],
-                                 self.similarity(iLeft, iRight)):
-                alignment.append((iLeft, iRight))
-                iLeft, iRight = iLeft-1, iRight-1
-            elif score == self.add(matrix[iLeft,iRight-1],
-                                   self.gap_penalty):
-                alignment.append((None, iRight))
-                iRight -= 1
-            elif score == self.add(matrix[iLeft-1,iRight],
-                                   self.gap_penalty):
-                alignment.append((iLeft, None))
-                iLeft -= 1
-            else:
-                raise Exception
-
-        while 0 <= iRight:
-            alignment.append((None,iRight))
-            iRight -= 1
-
-        while 0 <= iLeft:
-            alignment.append((iLeft,None))
-            iLeft -= 1
-
-        alignment.reverse()
-        self.alignment = alignment
+        top = [self.zero] * len(self.right)
+        if 0 <= iLeft:
+            iLeft, iRight = self._hirschberg(0, iLeft, top, iRight, alignment)
+        self.finish_alignment(alignment, iLeft, iRight)
+
+    def _hirschberg(self, lo, hi, top, iRight, alignment):
+        """Trace back from (hi, iRight) through rows lo..hi.
+
+        top is row lo-1 of the matrix. Returns where the traceback left
+        the block."""
+        if iRight < 0:
+            return hi, iRight
+
+        if lo == hi or (hi - lo + 1) * len(top) <= self.hirschberg_block:
+            pointers = Pointers(hi - lo + 1, len(top), first_row=lo)
+            row = top
+            for i in range(lo, hi + 1):
+                row, pointers_row = self.compute_row(row, i)
+                pointers.set_row(i, 0, pointers_row)
+            return self.follow_pointers(pointers, hi, iRight, alignment, lo)
+
+        mid = (lo + hi + 1) // 2
+        row = top
+        for i in range(lo, mid):
+            row = self.compute_row(row, i)[0]
+        iLeft, iRight = self._hirschberg(mid, hi, row, iRight, alignment)
+        del row
+        if iRight < 0:
+            return iLeft, iRight
+        return self._hirschberg(lo, iLeft, top, iRight, alignment)
+
+    # The numpy engine packs the lexicographic (exact, moves/levels, gap)
+    # score into a single integer. Scores along paths of at most cSteps steps
+    # differ in each component by at most cSteps times the spread of a step,
+    # which can go either way if the gap penalty has negative components.
+    # With one more than that much room per component, the lower ones can't
+    # outweigh a higher one, so adding and comparing packed scores agrees
+    # exactly with adding and comparing tuples.
+
+    def packing(self):
+        """Return the multiplier for each component of a packed score"""
+        cSteps = len(self.left) + len(self.right)
+        # a step is either similarity(), from (0, 0, 0) up to (1, 3, 0), or
+        # the gap penalty
+        highest = [max(0, a, b) for a, b in zip((1, 3, 0), self.gap_penalty)]
+        lowest = [min(0, b) for b in self.gap_penalty]
+        bases = [cSteps * (u - l) + 1 for u, l in zip(highest, lowest)]
+        multipliers = [1, 1, 1]
+        for k in (1, 0):
+            multipliers[k] = multipliers[k+1] * bases[k+1]
+        return multipliers
+
+    def pack(self, score, multipliers):
+        return sum(a * b for a, b in zip(score, multipliers))
+
+    def similarity_numpy(self):
+        """Compute the packed similarity() for every cell at once"""
+        cLeft, cRight = len(self.left), len(self.right)
+        right = numpy.array(self.right.codes(), dtype=numpy.int64)
+
+        def match(key):
+            # straight from the row indexes, so the cost doesn't depend on
+            # how many columns the table has
+            rows, values = self.left.index_pairs(key)
+            eq = numpy.zeros((cLeft, cRight), dtype=bool)
+            if values:
+                hits = (numpy.array(values, dtype=numpy.int64)[:, numpy.newaxis]
+                        == (right & key))
+                numpy.logical_or.at(eq, numpy.array(rows), hits)
+            return eq.astype(numpy.int64)
+
+        if not cLeft or not cRight:
+            return numpy.zeros((cLeft, cRight), dtype=numpy.int64)
+        exact = match(key_both)
+        middle = 2 * match(key_moves) + match(key_levels)
+        multipliers = self.packing()
+        return exact * multipliers[0] + middle * multipliers[1]
+
+    @profiled()
+    def compute_matrix_numpy(self):
+        """Fill the matrix a row at a time with vector operations.
+
+        Within a row, m[i,j] = max(c[j], m[i,j-1] + gap) where c[j] is the
+        best of the diagonal and vertical moves. Unrolled, that is
+
+            m[i,j] = j*gap + max(zero + gap, max(c[k] - k*gap for k <= j))
+
+        which is a running maximum.
+        """
+        multipliers = self.packing()
+        zero = self.pack(self.zero, multipliers)
+        gap = self.pack(self.gap_penalty, multipliers)
+        cLeft, cRight = len(self.left), len(self.right)
+
+        sim = self.similarity_numpy()
+        if profiler is not None:
+            # similarity() matches each cell on three keys
+            profiler.count('match', 3 * cLeft * cRight)
+        pointers = numpy.empty((cLeft, cRight), dtype=numpy.uint8)
+        if self.keep_matrix:
+            self.matrix = numpy.empty((cLeft, cRight), dtype=numpy.int64)
+        steps = numpy.arange(cRight, dtype=numpy.int64) * gap
+        fromdiag = numpy.empty(cRight, dtype=numpy.int64)
+        fromleft = numpy.empty(cRight, dtype=numpy.int64)
+        prev = numpy.full(cRight, zero, dtype=numpy.int64)
+        for iLeft in range(cLeft if cRight else 0):
+            fromdiag[0] = zero
+            fromdiag[1:] = prev[:-1]
+            fromdiag += sim[iLeft]
+            fromup = prev + gap
+            best = numpy.maximum(fromdiag, fromup)
+            best -= steps
+            numpy.maximum.accumulate(best, out=best)
+            numpy.maximum(best, zero + gap, out=best)
+            best += steps
+
+            fromleft[0] = zero + gap
+            fromleft[1:] = best[:-1] + gap
+            pointers[iLeft] = numpy.where(best == fromdiag, DIAG,
+                                          numpy.where(best == fromleft,
+                                                      LEFT, UP))
+            if self.keep_matrix:
+                self.matrix[iLeft] = best
+            prev = best
+
+        self.pointers = Pointers(cLeft, cRight)
+        self.pointers.data[:] = pointers.tobytes()
 
 
 class NeedlemanWunschMatrix(list):
-    """A 2-dimensional matrix used in the Needleman-Wunsch algorithm"""
-    def __init__(self, m, n, default):
+    """A 2-dimensional matrix used in the Needleman-Wunsch algorithm.
+
+    If rolling is true, only the last two rows are stored; row i reuses the
+    space of row i-2."""
+    def __init__(self, m, n, default, rolling=False):
         self.m = m
         self.n = n
         self.default = default
-        list.__init__(self, [None] * m * n)
+        self.rows = min(m, 2) if rolling else m
+        list.__init__(self, [None] * self.rows * n)
 
     def __getitem__(self, ij):
         i, j = ij
@@ -544,13 +1357,16 @@ class NeedlemanWunschMatrix(list):
             return self.default
         if self.m < i or self.n < j:
             raise IndexError(ij)
-        return list.__getitem__(self, i*self.n+j)
+        return list.__getitem__(self, (i % self.rows)*self.n+j)
 
     def __setitem__(self, ij, v):
         i, j = ij
         if not (0 <= i < self.m and 0 <= j < self.n):
             raise IndexError(ij)
-        list.__setitem__(self, i*self.n+j, v)
+        list.__setitem__(self, (i % self.rows)*self.n+j, v)
+
+    def columns(self, i):
+        return range(self.n)
 
     def __repr__(self):
         return 'Matrix(%s)' % list.__repr__(self)
@@ -559,6 +1375,93 @@ class NeedlemanWunschMatrix(list):
         return "\n".join(" ".join("%2d" % self[i, j] for j in range(self.n)) for i in range(self.m))
 
 
+def running_sums(values, zero, add):
+    """sums[k] is the total of values[:k]"""
+    sums = [zero]
+    for value in values:
+        sums.append(add(sums[-1], value))
+    return sums
+
+def nearest(levels, level):
+    """The distance from level to the nearest of the sorted levels"""
+    i = bisect_left(levels, level)
+    return min([abs(levels[k] - level) for k in (i - 1, i)
+                if 0 <= k < len(levels)])
+
+class BandedMatrix:
+    """A 2-dimensional matrix which only stores a diagonal band.
+
+    Row i holds the cells within width columns of the diagonal running from
+    the top left corner to the bottom right one. Cells outside the band read
+    as outside. Cells just outside the matrix, at index -1, read as border,
+    except for (-1, -1) which reads as corner if it is given.
+    """
+    def __init__(self, m, n, width, outside, border, corner=None):
+        self.m = m
+        self.n = n
+        self.width = width
+        self.outside = outside
+        self.border = border
+        self.corner = corner
+        self.bounds = []
+        self.rows = []
+        for i in range(m):
+            lo = max(0, i * n // m - width)
+            hi = min(n - 1, -(-(i + 1) * n // m) - 1 + width)
+            self.bounds.append((lo, hi))
+            self.rows.append([None] * (hi - lo + 1))
+
+    def __getitem__(self, ij):
+        i, j = ij
+        if i < 0 or j < 0:
+            if ij == (-1, -1) and self.corner is not None:
+                return self.corner
+            return self.border
+        lo, hi = self.bounds[i]
+        if j < lo or hi < j:
+            return self.outside
+        return self.rows[i][j - lo]
+
+    def __setitem__(self, ij, v):
+        i, j = ij
+        lo, hi = self.bounds[i]
+        if not (lo <= j <= hi):
+            raise IndexError(ij)
+        self.rows[i][j - lo] = v
+
+    def __repr__(self):
+        return 'BandedMatrix(%r, %r)' % (self.bounds, self.rows)
+
+    def columns(self, i):
+        lo, hi = self.bounds[i]
+        return range(lo, hi + 1)
+
+    def exits(self):
+        """Yield each cell outside the band that a path can go through
+        first, from a cell in the band or from the border.
+
+        Any path which leaves the band goes through one of these."""
+        lo = 0
+        for i, (lo_i, hi_i) in enumerate(self.bounds):
+            if i == 0:
+                # from the border above the matrix
+                cells = range(hi_i + 1, self.n)
+            else:
+                # down from the row above, or right from the end of the band
+                cells = list(range(lo, lo_i))
+                if hi_i + 1 < self.n:
+                    cells.append(hi_i + 1)
+                # from the border left of the matrix
+                if 0 < lo_i and 0 < lo:
+                    cells.insert(0, 0)
+            for j in cells:
+                yield i, j
+            lo = lo_i
+
+    def is_full(self):
+        return all(lo == 0 and hi == self.n - 1 for lo, hi in self.bounds)
+
+
 class DTWMoveAligner(MoveAligner):
     """
     Dynamic Time Warping for pok\xe9mon levels.
@@ -568,9 +1471,14 @@ class DTWMoveAligner(MoveAligner):
 
     http://en.wikipedia.org/wiki/Dynamic_time_warping,
 
+    Setting band to a number turns on the banded mode (see compute_banded).
+    As with NeedlemanWunschMoveAligner, only the last rows of the matrix are
+    kept unless keep_matrix is set.
     """
     zero = 0
     inf = 100000
+    band = None
+    keep_matrix = False
 
     def __init__(self, left, right):
         self.left = left
@@ -578,79 +1486,91 @@ class DTWMoveAligner(MoveAligner):
 
     def clear(self):
         self.alignment = []
-        self.matrix = DTWMatrix(len(self.left), len(self.right),
-                                inf=self.inf, zero=self.zero)
-
+        self.matrix = None
+        self.pointers = None
+        if self.band is None:
+            cLeft, cRight = len(self.left), len(self.right)
+            self.matrix = DTWMatrix(cLeft, cRight, inf=self.inf, zero=self.zero,
+                                    rolling=not self.keep_matrix)
+            self.pointers = Pointers(cLeft, cRight)
+
+    @profiled_align
     def align(self):
         self.clear()
 
-        self.compute_matrix()
-        self.compute_alignment()
+        if self.band is not None:
+            self.compute_banded()
+        else:
+            self.compute_matrix()
+            self.compute_alignment()
 
         #self.fill_gaps()
         self.sort_levels()
 
         return self.apply_alignment()
 
+    def banded_matrix(self, width):
+        return BandedMatrix(len(self.left), len(self.right), width,
+                            outside=self.inf, border=self.inf, corner=self.zero)
+
     def distance(self, iLeft, iRight):
         mLeft = self.lvalue(iLeft)
-        return abs(key_levels(mLeft) -
-                   key_levels(self.right[iRight]))
+        return abs(level_of(mLeft) - self.right.levels[iRight])
 
     def add(self, a, b):
         return a + b
 
+    def band_is_exact(self):
+        """Whether the full matrix would give the banded alignment too.
+
+        As for NeedlemanWunschMoveAligner, but a path has to go through
+        every row and every move, so its cost is at least the sum of the
+        least distance of each row, and of each move."""
+        cLeft, cRight = len(self.left), len(self.right)
+        cost = self.matrix[cLeft-1, cRight-1]
+        aLeft = sorted(level_of(self.lvalue(i)) for i in range(cLeft))
+        aRight = sorted(self.right.levels)
+        rows = [nearest(aRight, level_of(self.lvalue(i)))
+                for i in range(cLeft)]
+        columns = [nearest(aLeft, level) for level in self.right.levels]
+        aRows = running_sums(rows, 0, self.add)
+        aColumns = running_sums(columns, 0, self.add)
+        for iLeft, iRight in self.matrix.exits():
+            before = max(aRows[iLeft+1], aColumns[iRight+1])
+            after = max(aRows[-1] - aRows[iLeft+1],
+                        aColumns[-1] - aColumns[iRight+1])
+            if not cost < self.zero + before + after:
+                return False
+        return True
+
+    @profiled()
     def compute_matrix(self):
         m = self.matrix
+        pointers = self.pointers
         for iLeft in range(len(self.left)):
-            for iRight in range(len(self.right)):
+            for iRight in m.columns(iLeft):
                 cost = self.distance(iLeft, iRight)
-                m[iLeft,iRight] = self.add(cost, min(
-                    m[iLeft-1,iRight-1],
-                    m[iLeft-1,iRight],
-                    m[iLeft,iRight-1],
-                ))
-
-    def compute_alignment(self):
-        matrix = self.matrix
-
-        iLeft, iRight = len(self.left)-1, len(self.right)-1
-        alignment = []
-        while 0 <= iLeft and 0 <= iRight:
-            score = matrix[iLeft, iRight]
-            cost = self.distance(iLeft, iRight)
-            if score == self.add(cost, matrix[iLeft-1,iRight-1]):
-                alignment.append((iLeft, iRight))
-                iLeft, iRight = iLeft-1, iRight-1
-            elif score == self.add(cost, matrix[iLeft,iRight-1]):
-                alignment.append((None, iRight))
-                iRight -= 1
-            elif score == self.add(cost, matrix[iLeft-1,iRight]):
-                alignment.append((iLeft, None))
-                iLeft -= 1
-            else:
-                raise Exception #(score, cost, iLeft, iRight, self)
-
-        while 0 <= iRight:
-            alignment.append((None,iRight))
-            iRight -= 1
-
-        while 0 <= iLeft:
-            alignment.append((iLeft,None))
-            iLeft -= 1
-
-        alignment.reverse()
-        self.alignment = alignment
+                fromdiag = m[iLeft-1,iRight-1]
+                fromleft = m[iLeft,iRight-1]
+                fromup = m[iLeft-1,iRight]
+                best = min(fromdiag, fromleft, fromup)
+                m[iLeft,iRight] = self.add(cost, best)
+                pointers[iLeft,iRight] = (DIAG if best == fromdiag else
+                                          LEFT if best == fromleft else UP)
 
 
 class DTWMatrix(list):
-    """A 2-dimensional matrix used in the Dynamic Time Warping algorithm"""
-    def __init__(self, m, n, inf, zero=0):
+    """A 2-dimensional matrix used in the Dynamic Time Warping algorithm.
+
+    If rolling is true, only the last two rows are stored; row i reuses the
+    space of row i-2."""
+    def __init__(self, m, n, inf, zero=0, rolling=False):
         self.m = m
         self.n = n
         self.inf = inf
         self.zero = zero
-        list.__init__(self, [None] * m * n)
+        self.rows = min(m, 2) if rolling else m
+        list.__init__(self, [None] * self.rows * n)
 
     def __getitem__(self, ij):
         i, j = ij
@@ -660,13 +1580,16 @@ class DTWMatrix(list):
             return self.inf
         if self.m < i or self.n < j:
             raise IndexError(ij)
-        return list.__getitem__(self, i*self.n+j)
+        return list.__getitem__(self, (i % self.rows)*self.n+j)
 
     def __setitem__(self, ij, v):
         i, j = ij
         if not (0 <= i < self.m and 0 <= j < self.n):
             raise IndexError(ij)
-        list.__setitem__(self, i*self.n+j, v)
+        list.__setitem__(self, (i % self.rows)*self.n+j, v)
+
+    def columns(self, i):
+        return range(self.n)
 
     def __repr__(self):
         return 'Matrix(%s)' % list.__repr__(self)
@@ -675,36 +1598,436 @@ class DTWMatrix(list):
         return "\n".join(" ".join("%2d" % self[i, j] for j in range(self.n)) for i in range(self.m))
 
 
-def align(movesets, aligner_class=HeuristicMoveAligner):
+class Profile(list):
+    """A combined table of Rows, as aligned by ProfileMoveAligner.
+
+    columns are the indices of the movesets the columns came from, and
+    levels holds the level of the first move in each row (which is what
+    sort_levels and skip_lv1 look at on the right)."""
+    def __init__(self, rows, columns):
+        list.__init__(self, rows)
+        self.columns = list(columns)
+        self.levels = [level_of(row.first) for row in rows]
+
+    @classmethod
+    def leaf(cls, moveset, column):
+        return cls([Row([x]) for x in moveset.codes()], [column])
+
+class ProfileMoveAligner(NeedlemanWunschMoveAligner):
+    """
+    Needleman-Wunsch between two combined tables (Profiles).
+
+    Two rows match on a key when any move of one matches any move of the
+    other, so aligning a table against a single-column one gives the same
+    scores as NeedlemanWunschMoveAligner. The combined table has the left
+    table's columns followed by the right one's.
+    """
+    def match(self, iLeft, iRight, key=key_both):
+        return bool(self.left[iLeft].index[key] &
+                    self.right[iRight].index[key])
+
+    def index_sets(self, key):
+        return ([row.index[key] for row in self.left],
+                [row.index[key] for row in self.right])
+
+    def similarity_numpy(self):
+        cLeft, cRight = len(self.left), len(self.right)
+        if not cLeft or not cRight:
+            return numpy.zeros((cLeft, cRight), dtype=numpy.int64)
+        def codes(table):
+            return numpy.array([[-1 if x is None else x for x in row]
+                                for row in table], dtype=numpy.int64)
+        a = codes(self.left)[:, :, numpy.newaxis, numpy.newaxis]
+        b = codes(self.right)[numpy.newaxis, numpy.newaxis, :, :]
+        gaps = (a < 0) | (b < 0)
+
+        def match(key):
+            eq = (a & key) == (b & key)
+            eq &= ~gaps
+            return eq.any(axis=3).any(axis=1).astype(numpy.int64)
+
+        exact = match(key_both)
+        middle = 2 * match(key_moves) + match(key_levels)
+        multipliers = self.packing()
+        return exact * multipliers[0] + middle * multipliers[1]
+
+    @profiled()
+    def apply_alignment(self):
+        left = self.left
+        right = self.right
+        cLeft = len(left.columns)
+        cRight = len(right.columns)
+        final = []
+        for iLeft, iRight in self.alignment:
+            if iLeft is None:
+                final.append(Row([None] * cLeft + right[iRight]))
+            elif iRight is None:
+                final.append(Row(left[iLeft] + [None] * cRight))
+            else:
+                final.append(Row(left[iLeft] + right[iRight]))
+        return Profile(final, left.columns + right.columns)
+
+
+class AlignmentMemo:
+    """An in-process LRU cache of partly aligned tables.
+
+    align() folds the movesets into the combined table one at a time. The
+    memo keeps the table after every step, keyed by the aligner class and
+    the content of the movesets folded in so far, so a later call which
+    starts the same way (ends the same way, for RTL aligners) picks up
+    where the earlier one stopped. Any member of an evolution family gets
+    the same movesets, so they all share one entry.
+
+    Moves are keyed by their interned ids, so a memo should only be used
+    with one MoveNames table. Call clear() after changing the settings of
+    an aligner class.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def __repr__(self):
+        return "<%s %d entries, %d hits, %d misses>" % (
+            self.__class__.__name__, len(self.entries), self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, aligner_class, movesets):
+        return (aligner_class,) + tuple(
+            (m.levels.tobytes(), m.moves.tobytes()) for m in movesets)
+
+    def longest(self, aligner_class, movesets):
+        """Find the longest cached prefix of movesets.
+
+        Returns (count, combined); count is 0 if nothing is cached."""
+        self.lock.acquire()
+        try:
+            for count in range(len(movesets), 0, -1):
+                key = self.key(aligner_class, movesets[:count])
+                if key in self.entries:
+                    combined = self.entries.pop(key)
+                    self.entries[key] = combined
+                    self.hits += 1
+                    return count, combined
+            self.misses += 1
+            return 0, None
+        finally:
+            self.lock.release()
+
+    def store(self, aligner_class, movesets, combined):
+        key = self.key(aligner_class, movesets)
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = combined
+            while self.size < len(self.entries):
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+
+def align(movesets, aligner_class=HeuristicMoveAligner, names=move_names,
+          memo=None, dedupe=False):
+    """Align a list of movesets, returning the combined table.
+
+    If dedupe is true, a run of identical movesets (say, one pokemon in
+    several versions which didn't change its moves) is aligned as a single
+    column, and copied back out into one column each afterwards."""
+    movesets = [encode(moveset, names) for moveset in movesets]
+    if not dedupe:
+        return decode(align_encoded(movesets, aligner_class, memo), names)
+    movesets, counts = collapse_runs(movesets)
+    combined = decode(align_encoded(movesets, aligner_class, memo), names)
+    return expand_runs(combined, counts)
+
+def collapse_runs(movesets):
+    """Drop each Moveset which is the same as the one before it.
+
+    Returns (distinct movesets, length of each run)."""
+    distinct = []
+    counts = []
+    for moveset in movesets:
+        if (distinct and distinct[-1].levels == moveset.levels
+                and distinct[-1].moves == moveset.moves):
+            counts[-1] += 1
+        else:
+            distinct.append(moveset)
+            counts.append(1)
+    return distinct, counts
+
+def expand_runs(table, counts):
+    """The reverse of collapse_runs, for an aligned table"""
+    return [[x for x, count in zip(row, counts) for _ in range(count)]
+            for row in table]
+
+def align_encoded(movesets, aligner_class=HeuristicMoveAligner, memo=None):
+    """Align a list of Movesets, returning the encoded table.
+
+    If memo is an AlignmentMemo, partial results are looked up in and
+    stored to it."""
     if aligner_class.style == 'LTR':
-        combined = [[x] for x in movesets[0]]
-        for moveset in movesets[1:]:
-            aligner = aligner_class(combined, moveset)
-            combined = aligner.align()
+        order = list(movesets)
     elif aligner_class.style == 'RTL':
-        combined = [[x] for x in movesets[-1]]
-        for moveset in movesets[-2::-1]:
-            aligner = aligner_class(moveset, combined)
-            combined = aligner.align()
-    return combined
+        order = list(movesets)[::-1]
+
+    count = 0
+    if memo is not None:
+        count, combined = memo.longest(aligner_class, order)
+        if 0 < count < len(order):
+            # the aligners change the table in place
+            combined = combined.copy()
+    if count == 0:
+        combined = Table.from_moveset(order[0])
+        count = 1
+
+    for i in range(count, len(order)):
+        if aligner_class.style == 'LTR':
+            aligner = aligner_class(combined, order[i])
+        else:
+            aligner = aligner_class(order[i], combined)
+        combined = aligner.align()
+        if memo is not None:
+            memo.store(aligner_class, order[:i+1],
+                       combined if i == len(order) - 1 else combined.copy())
+    return combined.rows()
+
+
+def pack_movesets(movesets):
+    """Encode movesets into a compact form for sending to another process.
+
+    The moves are interned in a table of their own, so the result doesn't
+    depend on what else has been interned. Returns (names, columns) where
+    columns is a list of (levels, moves) byte strings.
+    """
+    names = MoveNames()
+    columns = []
+    for moveset in movesets:
+        moveset = Moveset(moveset, names)
+        columns.append((moveset.levels.tobytes(), moveset.moves.tobytes()))
+    return tuple(names.names), columns
+
+def unpack_movesets(packed):
+    """The reverse of pack_movesets. Returns (names, movesets)"""
+    names, columns = packed
+    names = MoveNames(names)
+    movesets = []
+    for levels, moves in columns:
+        moveset = Moveset((), names)
+        moveset.levels.frombytes(levels)
+        moveset.moves.frombytes(moves)
+        movesets.append(moveset)
+    return names, movesets
+
+def _align_packed(packed, aligner_class):
+    names, movesets = unpack_movesets(packed)
+    return [list(row) for row in align_encoded(movesets, aligner_class)]
+
+def align_many(jobs, aligner_class=HeuristicMoveAligner, workers=None,
+               ordered=False):
+    """Align many lists of movesets in a pool of worker processes.
+
+    jobs is an iterable of (key, movesets) pairs. Yields (key, combined)
+    pairs as the workers finish them, or in the order of jobs if ordered
+    is true. workers defaults to the number of CPUs.
+
+    Each job is packed with its own move table (see pack_movesets), so the
+    results don't depend on which worker ran which job. Note that the
+    workers see the aligner class as it is defined in the module; settings
+    changed on it at runtime may not carry over.
+    """
+    from concurrent import futures
+
+    executor = futures.ProcessPoolExecutor(workers)
+    try:
+        submitted = []
+        for key, movesets in jobs:
+            packed = pack_movesets(movesets)
+            future = executor.submit(_align_packed, packed, aligner_class)
+            submitted.append((future, key, packed[0]))
+
+        if ordered:
+            done = submitted
+        else:
+            keys = dict((future, (key, names))
+                        for future, key, names in submitted)
+            done = ((future,) + keys[future]
+                    for future in futures.as_completed(keys))
+        for future, key, names in done:
+            yield key, decode(future.result(), names)
+    finally:
+        executor.shutdown()
+
+def time_packed(packed, aligner_class):
+    """Align movesets packed by pack_movesets, in a worker process.
+
+    Returns (seconds, encoded table)."""
+    names, movesets = unpack_movesets(packed)
+    time_a = time()
+    combined = align_encoded(movesets, aligner_class)
+    time_b = time()
+    return (time_b - time_a), [list(row) for row in combined]
+
+def compare_aligners(movesets, aligner_classes, executor=None, dedupe=False):
+    """Align movesets with each of aligner_classes, all at once in worker
+    processes.
+
+    Returns (seconds, combined) for each aligner class, in order. The time
+    is taken in the worker, around the alignment alone, so it doesn't
+    include sending the movesets over or waiting for a free worker.
+    executor is a concurrent.futures executor to run them in; by default a
+    process pool is started for the call. dedupe is as for align().
+    """
+    counts = None
+    if dedupe:
+        movesets, counts = collapse_runs([encode(moveset)
+                                          for moveset in movesets])
+    packed = pack_movesets(movesets)
+
+    own_executor = executor is None
+    if own_executor:
+        from concurrent import futures
+        executor = futures.ProcessPoolExecutor(len(aligner_classes))
+    try:
+        submitted = [executor.submit(time_packed, packed, aligner_class)
+                     for aligner_class in aligner_classes]
+        results = []
+        for future in submitted:
+            seconds, combined = future.result()
+            combined = decode(combined, packed[0])
+            if counts is not None:
+                combined = expand_runs(combined, counts)
+            results.append((seconds, combined))
+        return results
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+
+def similarity(a, b):
+    """How alike two Movesets are, from 0 to 1, for building guide trees"""
+    if not len(a) and not len(b):
+        return 1.0
+    a_codes, b_codes = set(a.codes()), set(b.codes())
+    a_moves, b_moves = set(a.moves), set(b.moves)
+    shared = len(a_codes & b_codes) + len(a_moves & b_moves)
+    return shared / (float(len(a_codes) + len(a_moves) +
+                           len(b_codes) + len(b_moves)) / 2 or 1.0)
+
+def guide_tree(movesets):
+    """Cluster movesets by similarity (UPGMA).
+
+    Returns a binary tree of nested pairs, with indices into movesets as
+    leaves, e.g. ((0, 2), (1, (3, 4)))."""
+    clusters = [(i, 1) for i in range(len(movesets))] # (tree, size)
+    sims = {}
+    for i in range(len(movesets)):
+        for j in range(i + 1, len(movesets)):
+            sims[i, j] = similarity(movesets[i], movesets[j])
+
+    while len(clusters) > 1:
+        best = None
+        for i in range(len(clusters)):
+            for j in range(i + 1, len(clusters)):
+                if best is None or sims[best] < sims[i, j]:
+                    best = i, j
+        i, j = best
+        (ti, ni), (tj, nj) = clusters[i], clusters[j]
+        merged = (ti, tj), ni + nj
+
+        # average linkage, renumbering around the two merged clusters
+        new_sims = {}
+        keep = [k for k in range(len(clusters)) if k not in (i, j)]
+        for a in range(len(keep)):
+            for b in range(a + 1, len(keep)):
+                new_sims[a, b] = sims[keep[a], keep[b]]
+        for a, k in enumerate(keep):
+            si = sims[min(i, k), max(i, k)]
+            sj = sims[min(j, k), max(j, k)]
+            new_sims[a, len(keep)] = (si * ni + sj * nj) / float(ni + nj)
+        clusters = [clusters[k] for k in keep] + [merged]
+        sims = new_sims
+
+    if not clusters:
+        return None
+    return clusters[0][0]
+
+def _merge_profiles(aligner_class, left, right):
+    return aligner_class(left, right).align()
+
+def align_tree(movesets, aligner_class=ProfileMoveAligner, names=move_names,
+               executor=None):
+    """Align movesets progressively along a guide tree.
+
+    The most similar movesets are aligned first, and the partial tables
+    are then aligned with each other (see ProfileMoveAligner) up the tree.
+    Merges whose subtrees are done don't depend on each other. If executor
+    (a concurrent.futures Executor) is given, each level of the tree is
+    merged in it concurrently, so the time grows with the depth of the tree
+    rather than the number of movesets. The columns of the result are in
+    the order of movesets.
+    """
+    movesets = [encode(moveset, names) for moveset in movesets]
+    tree = guide_tree(movesets)
+    if tree is None:
+        return []
+
+    # nodes by height; a node only depends on nodes below it
+    levels = []
+    def height(node):
+        if not isinstance(node, tuple):
+            return 0
+        h = 1 + max(height(node[0]), height(node[1]))
+        while len(levels) < h:
+            levels.append([])
+        levels[h - 1].append(node)
+        return h
+    height(tree)
+
+    profiles = dict((i, Profile.leaf(moveset, i))
+                    for i, moveset in enumerate(movesets))
+    for nodes in levels:
+        if executor is None:
+            for node in nodes:
+                profiles[node] = _merge_profiles(aligner_class,
+                                                 profiles[node[0]],
+                                                 profiles[node[1]])
+        else:
+            futures = [(node, executor.submit(_merge_profiles, aligner_class,
+                                              profiles[node[0]],
+                                              profiles[node[1]]))
+                       for node in nodes]
+            for node, future in futures:
+                profiles[node] = future.result()
+
+    table = profiles[tree]
+    order = [table.columns.index(i) for i in range(len(movesets))]
+    return decode([[row[k] for k in order] for row in table], names)
 
 
-from time import time
 def time_align2(movesets, ia, ib):
     a = movesets[ia][1]
     b = movesets[ib][1]
 
-    a = [[x] for x in a]
+    a = Table.from_moveset(encode(a))
+    b = encode(b)
 
     aligner = HeuristicMoveAligner(a, b)
     time_a = time()
     combined = aligner.align()
     time_b = time()
-    return (time_b - time_a), combined
+    return (time_b - time_a), decode(combined)
 
-def time_align(movesets, aligner_class=HeuristicMoveAligner):
+def time_align(movesets, aligner_class=HeuristicMoveAligner, memo=None,
+               dedupe=False):
     time_a = time()
-    combined = align(movesets, aligner_class)
+    combined = align(movesets, aligner_class, memo=memo, dedupe=dedupe)
     time_b = time()
     return (time_b - time_a), combined
 
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+comparify_async.py - an asyncio HTTP server for the comparify pages
+
+The event loop only deals with connections. The pokemon database queries
+run in one bounded thread pool and the alignments in another, so a burst of
+slow pages can't tie up more than a fixed number of threads.
+
+Identical requests that arrive while the first one is still being worked
+on share its result instead of starting their own; the quicklinks on the
+index page tend to get hit by several people at once. If every client
+waiting for a page hangs up, the work for it is cancelled (any step which
+has already started in a thread still runs to completion, but the steps
+after it don't).
+
+Only GET is supported, and every connection is closed after one response.
+A client which half-closes its side of the connection after sending the
+request is taken to have hung up.
+
+Usage: comparify_async.py [port]
+"""
+
+import sys
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import comparify_web
+import pokemon
+
+class Server:
+    # pokemon hands out connections from a pool, so the queries can run in
+    # as many threads as it has connections
+    def __init__(self, db_workers=None, align_workers=4):
+        if db_workers is None:
+            db_workers = pokemon.POOL_SIZE
+        self.db = ThreadPoolExecutor(db_workers)
+        self.aligner = ThreadPoolExecutor(align_workers)
+        self.inflight = {} # key -> [task, number of waiters]
+
+    async def render(self, query, accept):
+        loop = asyncio.get_running_loop()
+        params = parse_qs(query)
+        if 'pokemon_id' not in params:
+            return await loop.run_in_executor(self.db,
+                                              comparify_web.page_index, params)
+        loaded = await loop.run_in_executor(self.db,
+                                            comparify_web.load_compare, params)
+        return await loop.run_in_executor(self.aligner,
+                                          comparify_web.render_compare,
+                                          accept, *loaded)
+
+    async def page(self, query, accept):
+        """Render a page, sharing the work with identical requests"""
+        # the pages only care whether there is an Accept header
+        key = query, bool(accept)
+        entry = self.inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(self.render(query, accept))
+            entry = self.inflight[key] = [task, 0]
+            def done(task, entry=entry):
+                if self.inflight.get(key) is entry:
+                    del self.inflight[key]
+            task.add_done_callback(done)
+
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+                # the task only finishes a tick later; a request which
+                # comes in before then must start its own
+                if self.inflight.get(key) is entry:
+                    del self.inflight[key]
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            parts = request.decode('latin-1').split()
+            if len(parts) != 3:
+                await self.respond(writer, "400 Bad Request")
+                return
+            method, target, version = parts
+            if method != 'GET':
+                await self.respond(writer, "405 Method Not Allowed",
+                                   [("Allow", "GET")])
+                return
+
+            query = urlsplit(target).query
+            params = parse_qs(query)
+            if 'pokemon_id' in params:
+                try:
+                    comparify_web.parse_compare(params)
+                except (ValueError, KeyError):
+                    await self.respond(writer, "400 Bad Request",
+                                       body="Bad request")
+                    return
+
+            page = asyncio.ensure_future(
+                self.page(query, headers.get('accept', '')))
+            hangup = asyncio.ensure_future(reader.read())
+            await asyncio.wait([page, hangup],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not page.done():
+                page.cancel()
+                return
+            hangup.cancel()
+
+            try:
+                type, body = page.result()
+            except LookupError:
+                await self.respond(writer, "404 Not Found",
+                                   body="No such pokemon")
+                return
+            except Exception:
+                traceback.print_exc()
+                await self.respond(writer, "500 Internal Server Error",
+                                   body="Internal server error")
+                return
+            await self.respond(writer, "200 OK",
+                               [("Content-Type",
+                                 comparify_web.content_type(type))],
+                               body)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, headers=(), body=""):
+        body = body.encode('utf-8')
+        head = ["HTTP/1.1 " + status]
+        head.extend("%s: %s" % header for header in headers)
+        head.append("Content-Length: %d" % len(body))
+        head.append("Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+
+    async def serve(self, host='', port=8000):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    pokemon.SNAPSHOT = True
+    port = int(sys.argv[1]) if 1 < len(sys.argv) else 8000
+    asyncio.run(Server().serve(port=port))
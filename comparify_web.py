@@ -0,0 +1,430 @@
+#!/usr/bin/env python3.1
+"""
+comparify_web.py - the comparify pages, as a WSGI application
+
+Run it from a long-lived process (mod_wsgi, a WSGI server, or this file
+itself for testing) so that the database connection, the index page and the
+alignment memo are kept between requests. comparify.cgi runs the same
+application as a CGI script. A long-lived process should also set
+pokemon.SNAPSHOT, so the movesets are read into memory once instead of
+being queried for on every request.
+
+Compare pages are sent as they are rendered: the head of the page first,
+then the tables a block of rows at a time (see stream_compare).
+
+The HTML pages are aligned with default_aligner, and the plain text ones
+with plaintext_aligner. Adding compare=1 to the query string aligns them
+with each of compared_aligners instead, at the same time in a pool of
+processes, and shows how long each took and where their tables differ.
+"""
+
+import threading
+from pprint import pprint, pformat
+from textwrap import dedent
+from urllib.parse import parse_qs
+
+import comparify
+import pokemon
+import aligncache
+
+version_map = 'rb y gs c rs e frlg dp pt hgss'
+version_map = {v: i+1 for i, v in enumerate(version_map.split())}
+version_names = {i: v for v, i in version_map.items()}
+
+# Partly aligned tables, shared by every request this process serves.
+# Requests for any member of an evolution family are turned into a request
+# for the whole family (see page_compare), so they all hit the same entries.
+memo = comparify.AlignmentMemo()
+
+# The aligners for the HTML and the plain text pages, and the two aligners
+# compared with compare=1
+default_aligner = comparify.HeuristicMoveAlignerRTL
+plaintext_aligner = comparify.HeuristicMoveAligner
+compared_aligners = (comparify.HeuristicMoveAlignerRTL,
+                     comparify.NeedlemanWunschMoveAligner)
+
+_executor = None # the process pool for compare=1, started on first use
+_executor_lock = threading.Lock()
+
+def executor():
+    global _executor
+    _executor_lock.acquire()
+    try:
+        if _executor is None:
+            from concurrent import futures
+            _executor = futures.ProcessPoolExecutor(len(compared_aligners))
+        return _executor
+    finally:
+        _executor_lock.release()
+
+
+def application(environ, start_response):
+    if environ.get('REQUEST_METHOD', "GET") != "GET":
+        start_response("405 Method Not Allowed", [("Allow", "GET")])
+        return []
+
+    params = parse_qs(environ.get('QUERY_STRING', ''))
+    if 'pokemon_id' in params:
+        try:
+            parse_compare(params)
+        except (ValueError, KeyError):
+            return respond(start_response, "400 Bad Request", "text/plain",
+                           "Bad request")
+        try:
+            loaded = load_compare(params)
+        except LookupError:
+            return respond(start_response, "404 Not Found", "text/plain",
+                           "No such pokemon")
+        # the length of a compare page isn't known until it is done, so
+        # it is sent as it is rendered
+        type, chunks = stream_compare(environ.get('HTTP_ACCEPT', ''),
+                                      *loaded)
+        start_response("200 OK", [("Content-Type", content_type(type))])
+        return encode_chunks(chunks)
+
+    return respond(start_response, "200 OK", *page_index(params))
+
+def respond(start_response, status, type, body):
+    body = body.encode('utf-8')
+    start_response(status, [
+        ("Content-Type", content_type(type)),
+        ("Content-Length", str(len(body))),
+    ])
+    return [body]
+
+BUFFER_SIZE = 8192
+
+def encode_chunks(chunks, size=BUFFER_SIZE):
+    """Encode the chunks of a page, in blocks of at least size bytes.
+
+    The first chunk goes out on its own, so the client has the head of the
+    page while the tables are aligned."""
+    chunks = iter(chunks)
+    for chunk in chunks:
+        yield chunk.encode('utf-8')
+        break
+
+    buffer = []
+    buffered = 0
+    for chunk in chunks:
+        chunk = chunk.encode('utf-8')
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if size <= buffered:
+            yield b"".join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield b"".join(buffer)
+
+# The quicklinks on the index page: (pokemon ids, label)
+quicklinks = [
+    ([144, 145, 146], "Articuno | Zapdos | Moltres"),
+    ([243, 244, 245], "Raikou | Entei | Suicune"),
+    ([249, 250], "Lugia | Ho-oh"),
+    ([377, 378, 379], "Regirock | Regiice | Registeel"),
+    ([380, 381], "Latias | Latios"),
+    ([382, 383, 384], "Kyogre | Groudon | Rayquaza"),
+    ([480, 481, 482], "Uxie | Mesprit | Azelf"),
+    ([483, 484, 487], "Dialga | Palkia | Giratina"),
+    ([488, 491], "Cresselia | Darkrai"),
+]
+
+def page_url(pokemon_ids, ver=None):
+    """The link to the compare page for pokemon_ids. ver is a key of
+    version_map, or 'all'; by default, the latest version."""
+    url = "?" + "&".join("pokemon_id=%d" % id for id in pokemon_ids)
+    if ver is not None:
+        url += "&ver=" + ver
+    return url
+
+def link_version(cache_key):
+    """The ver for page_url to keep the links of a page in its mode"""
+    if cache_key is None:
+        return None
+    subject, ver = cache_key
+    if subject[0] == 'versions':
+        return 'all'
+    if ver != pokemon.LATEST_VERSION:
+        return version_names[ver]
+    return None
+
+_index = None # the index page never changes, so it's only built once
+
+def page_index(params):
+    global _index
+    if _index is None:
+        _index = fmt_index()
+    return "text/html", _index
+
+def fmt_index(url=page_url):
+    template = """\
+    <!doctype>
+    <title>Comparifier</title>
+    <p>Compare with family
+     <form>
+      {select1}
+      <button type=submit>Go!</button>
+     </form>
+    <p>Compare across versions
+     <form>
+      {select1}
+      <input type=hidden name=ver value=all>
+      <button type=submit>Go!</button>
+     </form>
+    <p>Multi compare
+     <form>
+      {select1}
+      {select1}
+      {select2}
+      {select2}
+      <button type=submit>Go!</button>
+     </form>
+    <p>Quicklinks
+     <ul style="list-style: none; padding: 0;">
+      {links}
+      <!--<li><a href="?pokemon_id=&pokemon_id=&pokemon_id="></a>-->
+     </ul>
+    """
+
+    all_pokemon = pokemon.all_pokemon()
+    options = "".join(
+        "<option value={id}>{name}".format(id=p[0], name=p[1])
+        for p in all_pokemon)
+    select1 = "<select name=pokemon_id>{}</select>".format(options)
+    select2 = "<select name=pokemon_id><option value=\"\">-----------{}</select>".format(options)
+    links = "\n      ".join(
+        "<li><a href=\"{url}\">{label}</a>".format(url=url(ids), label=label)
+        for ids, label in quicklinks)
+    return template.format(**locals())
+
+def page_compare(params, accept):
+    return render_compare(accept, *load_compare(params))
+
+def parse_compare(params):
+    """Check the query of a compare page.
+
+    Returns (pokemon ids, ver, compare), where ver is a version number or
+    'all'. Raises ValueError or KeyError if the query is malformed."""
+    pokemon_ids = list(map(int, params['pokemon_id']))
+    compare = params.get('compare', ['0'])[0] not in ('', '0')
+    ver = params.get('ver', [None])[0]
+    if ver is None:
+        ver = pokemon.LATEST_VERSION
+    elif ver != 'all':
+        ver = version_map[ver]
+    return pokemon_ids, ver, compare
+
+def load_compare(params):
+    """Load the movesets for a compare page.
+
+    Returns (moves, pokemon_id, cache_key, compare) for render_compare.
+    With ver=all, the columns are the versions of a single pokemon. Raises
+    LookupError if a pokemon isn't in the pokedex, or has no moves in the
+    version."""
+    pokemon_ids, ver, compare = parse_compare(params)
+    if ver == 'all':
+        pokemon_id = pokemon_ids[0]
+        moves = [((id, "%s (%s)" % (name, version_names[v])), moveset)
+                 for v, ((id, name), moveset)
+                 in pokemon.moves_across_versions(pokemon_id,
+                                                  sorted(version_names))]
+        if not moves:
+            raise LookupError(pokemon_id)
+        return moves, pokemon_id, (('versions', pokemon_id), None), compare
+
+    if len(pokemon_ids) == 1:
+        pokemon_id = pokemon_ids[0]
+        evid = pokemon.evid_from_pokemonid(pokemon_id)
+        moves = pokemon.moves_from_evid(evid, ver)
+        if not moves:
+            raise LookupError(pokemon_id)
+        subject = ('evid', evid)
+    else:
+        pokemon_id = None
+        moves = pokemon.moves_from_pokemonids(pokemon_ids, ver)
+        subject = ('pokemon', pokemon_ids)
+    return moves, pokemon_id, (subject, ver), compare
+
+def render_compare(accept, moves, pokemon_id, cache_key, compare=False):
+    """Align and format a compare page"""
+    type, chunks = stream_compare(accept, moves, pokemon_id, cache_key,
+                                  compare)
+    return type, "".join(chunks)
+
+def stream_compare(accept, moves, pokemon_id, cache_key, compare=False):
+    """Like render_compare, but the page is an iterator of chunks of text.
+
+    Nothing is aligned until the first chunk is asked for."""
+    if not accept:
+        return "text/plain", iter_plaintext(moves, cache_key)
+    else:
+        return "text/html", iter_html(moves, pokemon_id, cache_key,
+                                      compare=compare)
+
+def content_type(type):
+    if type.startswith("text/") and "charset" not in type:
+        type += "; charset=utf-8"
+    return type
+
+def time_align(movesets, aligner_class, cache_key=None):
+    """Align movesets, through the alignment cache if cache_key is given.
+
+    cache_key is (subject, ver), see aligncache.time_align. The versions
+    of one pokemon (subject ('versions', id)) mostly share their movesets,
+    so runs of identical ones are only aligned once."""
+    if cache_key is None:
+        return comparify.time_align(movesets, aligner_class, memo)
+    subject, ver = cache_key
+    return aligncache.time_align(subject, ver, movesets, aligner_class, memo,
+                                 dedupe(cache_key))
+
+def dedupe(cache_key):
+    return cache_key is not None and cache_key[0][0] == 'versions'
+
+def compare_aligners(movesets, cache_key=None):
+    """Align movesets with each of compared_aligners, timing them afresh.
+
+    Neither the alignment cache nor the memo is used, as they would make
+    the times meaningless."""
+    return comparify.compare_aligners(movesets, compared_aligners,
+                                      executor(), dedupe(cache_key))
+
+def fmt_plaintext(moves, cache_key=None):
+    return "".join(iter_plaintext(moves, cache_key))
+
+def iter_plaintext(moves, cache_key=None):
+    pokemon, movesets = zip(*moves)
+    yield "%s\n\n" % ", ".join(name for _, name in pokemon)
+    time, combined = time_align(movesets, plaintext_aligner, cache_key)
+    yield "%s\n" % pformat(combined)
+
+def fmt_html(moves, current_id=None, cache_key=None, url=page_url,
+             compare=False):
+    return "".join(iter_html(moves, current_id, cache_key, url, compare))
+
+def iter_html(moves, current_id=None, cache_key=None, url=page_url,
+              compare=False):
+    """fmt_html, a chunk at a time: the head of the page, then the tables
+    row by row"""
+    pokemon, movesets = zip(*moves)
+    title = "%s Comparify" % "|".join(name for _, name in pokemon)
+    next = prev = ""
+    if current_id:
+        ver = link_version(cache_key)
+        prev_id, next_id = get_next_prev(pokemon, current_id)
+        if prev_id:
+            prev = """<link rel=prev href="%s">""" % url([prev_id], ver)
+        if next_id:
+            next = """<link rel=next href="%s">""" % url([next_id], ver)
+    yield dedent("""\
+    <!doctype html>
+    <title>{title}</title>
+    {prev}{next}
+    """).format(**locals())
+
+    if not compare:
+        time, combined = time_align(movesets, default_aligner, cache_key)
+        for chunk in iter_table(pokemon, combined):
+            yield chunk
+        return
+
+    (time, combined), (time2, combined2) = compare_aligners(movesets,
+                                                            cache_key)
+    if time < time2:
+        multiplier = (time2 / time) - 1
+        slower = "slower"
+        faster = "faster"
+    else:
+        multiplier = (time / time2) - 1
+        slower = "faster"
+        faster = "slower"
+    time *= 1000
+    time2 *= 1000
+
+    for chunk in iter_table(pokemon, combined):
+        yield chunk
+    if combined == combined2:
+        yield dedent("""
+        <p>{time:.3f} milliseconds vs {time2:.3f} milliseconds
+           ({multiplier:.3f}\xd7 {faster})</p>
+        """).format(**locals())
+    else:
+        yield dedent("""
+        <p>{time:f} milliseconds ({multiplier:.3f}\xd7 {faster})</p>
+        """).format(**locals())
+        for chunk in iter_table(pokemon, combined2):
+            yield chunk
+        yield dedent("""
+        <p>{time2:f} milliseconds ({multiplier:.3f}\xd7 {slower})</p>
+        """).format(**locals())
+
+def fmt_table(pokemon, combined):
+    return "".join(iter_table(pokemon, combined))
+
+def iter_table(pokemon, combined):
+    colgroups = "<colgroup span=2>" * len(pokemon)
+    thead = "".join("<th colspan=2>"+name for _, name in pokemon)
+    def fmt_move(move):
+        return ("<td>{}<td>{}".format(*move)
+            if move is not None else
+            "<td><td>")
+    def fmt_move_bold(move):
+        return ("<td>{}<td><b>{}</b>".format(*move)
+            if move is not None else
+            "<td><td>")
+    def fmt_move_italic(move):
+        return ("<td>{}<td><i>{}</i>".format(*move)
+            if move is not None else
+            "<td><td>")
+    def fmt_row(row):
+        # bold if every column has the same move, italic if the columns
+        # which have a move at all have the same one
+        move = None
+        gaps = False
+        for x in row:
+            if x is None:
+                gaps = True
+            elif move is None:
+                move = x[1]
+            elif x[1] != move:
+                return "<tr>" + "".join(map(fmt_move, row))
+        if move is None:
+            return "<tr>" + "".join(map(fmt_move, row))
+        elif not gaps:
+            return "<tr>" + "".join(map(fmt_move_bold, row))
+        else:
+            return "<tr>" + "".join(map(fmt_move_italic, row))
+
+    yield dedent("""\
+    <table>
+    {colgroups}
+    <thead>
+    <tr>{thead}</th>
+    <tbody>
+    """).format(**locals())
+    separator = ""
+    for row in combined:
+        yield separator + fmt_row(row)
+        separator = "\n"
+    yield "\n</table>\n"
+
+def get_next_prev(pokemon, current_id):
+    ids = set(x[0] for x in pokemon)
+    prev_id = next_id = current_id
+    while prev_id in ids:
+        prev_id -= 1
+    while next_id in ids:
+        next_id += 1
+    if prev_id < 1:
+        prev_id = None
+    if 493 < next_id:
+        next_id = None
+    return prev_id, next_id
+
+
+if __name__ == '__main__':
+    from wsgiref.simple_server import make_server
+    pokemon.SNAPSHOT = True
+    make_server('', 8000, application).serve_forever()
+
@@ -1,30 +1,150 @@
 #!/usr/bin/env python3.1
+import os
+import sys
+import mmap
+import time
+import struct
 import sqlite3
 import itertools
+import threading
+from array import array
+from contextlib import contextmanager
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
 
 DATABASE = '/home/andrew/veekun/pokedex/pokedex/data/pokedex.sqlite'
 
 LATEST_VERSION = 10
 
-_conn = None # database connection
+# The most connections the pool opens; see ConnectionPool
+POOL_SIZE = 8
 
-def _connect():
-    global _conn
-    if _conn is None:
-        _conn = sqlite3.connect(DATABASE)
+# If SNAPSHOT is true, the functions below are answered from an in-memory
+# copy of the database instead of with queries. The copy of each version is
+# loaded in one go the first time it's needed, so this only pays off in a
+# process which handles more than a few requests.
+SNAPSHOT = False
+
+# Where export() writes a snapshot of the database by default; see
+# use_snapshot_file
+SNAPSHOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'pokedex.snapshot')
+
+class ConnectionPool(object):
+    """Read-only connections to a database, shared between threads
+
+    Use connection() in a with statement to check a connection out. Up to
+    size connections are opened as they are needed; after that, callers
+    wait for one to be returned. The time spent waiting is recorded in
+    checkouts, waits, wait_time and max_wait.
+
+    The database is opened as immutable, so sqlite doesn't lock it or look
+    for changes: processes have to be restarted when it is updated.
+    """
+
+    def __init__(self, database, size=POOL_SIZE):
+        self.database = database
+        self.size = size
+        self.idle = Queue()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def open(self):
+        uri = "file:%s?mode=ro&immutable=1" % pathname2url(
+            os.path.abspath(self.database))
+        # queries are compiled once per connection and kept in its
+        # statement cache
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                               cached_statements=64)
+        conn.execute("PRAGMA query_only = 1")
+        conn.execute("PRAGMA mmap_size = 268435456")
+        conn.execute("PRAGMA cache_size = -16384")
+        return conn
+
+    def checkout(self):
+        try:
+            conn = self.idle.get_nowait()
+        except Empty:
+            with self.lock:
+                new = self.opened < self.size
+                if new:
+                    self.opened += 1
+            if new:
+                try:
+                    conn = self.open()
+                except:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+            else:
+                start = time.time()
+                conn = self.idle.get()
+                waited = time.time() - start
+                with self.lock:
+                    self.waits += 1
+                    self.wait_time += waited
+                    self.max_wait = max(self.max_wait, waited)
+        with self.lock:
+            self.checkouts += 1
+        return conn
+
+    def checkin(self, conn):
+        self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def stats(self):
+        with self.lock:
+            return dict(opened=self.opened, checkouts=self.checkouts,
+                        waits=self.waits, wait_time=self.wait_time,
+                        max_wait=self.max_wait)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def pool():
+    """The connection pool for DATABASE"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(DATABASE, POOL_SIZE)
+        return _pool
+
+def _query(query, params=()):
+    """Run query on a pooled connection, returning all the rows"""
+    with pool().connection() as conn:
+        return conn.execute(query, params).fetchall()
 
 def evid_from_pokemonid(pokemon_id):
-    _connect()
+    if SNAPSHOT:
+        return _pokedex().evid(pokemon_id)
     query = """
         SELECT evolution_chain_id
         FROM pokemon
         WHERE id = ?
     """
-    evid = _conn.execute(query, [pokemon_id]).fetchone()[0]
+    evid = _query(query, [pokemon_id])[0][0]
     return evid
 
 def moves_from_evid(evid, ver=LATEST_VERSION):
-    _connect()
+    if SNAPSHOT:
+        return _snapshot(ver).moves_from_evid(evid)
     query = """
         SELECT p.id, p.name,
                pe.from_pokemon_id as evparent,
@@ -38,14 +158,19 @@ def moves_from_evid(evid, ver=LATEST_VERSION):
             AND pm.pokemon_move_method_id = 1
         ORDER BY p.id, pm.level, pm."order"
     """
-    cur = _conn.execute(query, [ver, evid])
+    cur = _query(query, [ver, evid])
     movesets = []
     parents = {}
-    stages = {None: 0}
     for (id, name, evparent), group in itertools.groupby(cur, (lambda x: x[:3])):
         parents[id] = evparent
         movesets.append(((id, name), [x[3:] for x in group]))
 
+    return _sort_stages(movesets, parents)
+
+def _sort_stages(movesets, parents):
+    """Order the movesets of an evolution chain by evolution stage"""
+    stages = {None: 0}
+
     def stage(id):
         if id is None:
             return 0
@@ -69,7 +194,8 @@ def moves_from_evid(evid, ver=LATEST_VERSION):
     return movesets
 
 def moves_from_pokemonid(pokemon_id, ver=LATEST_VERSION):
-    _connect()
+    if SNAPSHOT:
+        return _snapshot(ver).moves_from_pokemonid(pokemon_id)
     query = """
         SELECT p.id, p.name,
                pm.level, m.name
@@ -81,18 +207,471 @@ def moves_from_pokemonid(pokemon_id, ver=LATEST_VERSION):
             AND pm.pokemon_move_method_id = 1
         ORDER BY p.id, pm.level, pm."order"
     """
-    cur = _conn.execute(query, [ver, pokemon_id])
+    cur = _query(query, [ver, pokemon_id])
     movesets = []
     for (id, name), group in itertools.groupby(cur, (lambda x: x[:2])):
         movesets.append(((id, name), [x[2:] for x in group]))
 
     return movesets[0]
 
+def moves_from_pokemonids(pokemon_ids, ver=LATEST_VERSION):
+    """Like moves_from_pokemonid for each of pokemon_ids, in one query.
+
+    The movesets are returned in the order of pokemon_ids. Raises KeyError
+    if one of them has no moves in ver."""
+    if SNAPSHOT:
+        return _snapshot(ver).moves_from_pokemonids(pokemon_ids)
+    unique = sorted(set(pokemon_ids))
+    query = """
+        SELECT p.id, p.name,
+               pm.level, m.name
+        FROM pokemon p
+        JOIN pokemon_moves pm ON pm.pokemon_id = p.id
+        JOIN moves m ON pm.move_id = m.id
+        WHERE pm.version_group_id = ?
+            AND p.id IN (%s)
+            AND pm.pokemon_move_method_id = 1
+        ORDER BY p.id, pm.level, pm."order"
+    """ % ", ".join("?" * len(unique))
+    cur = _query(query, [ver] + unique)
+    movesets = {}
+    for (id, name), group in itertools.groupby(cur, (lambda x: x[:2])):
+        movesets[id] = ((id, name), [x[2:] for x in group])
+
+    return [movesets[id] for id in pokemon_ids]
+
+def moves_across_versions(pokemon_id, versions=None):
+    """The movesets of one pokemon in each of versions, in one query.
+
+    versions defaults to every version up to LATEST_VERSION. Returns a list
+    of (ver, moveset), as for moves_from_pokemonid, for the versions the
+    pokemon has moves in, in the order of versions."""
+    if versions is None:
+        versions = range(1, LATEST_VERSION + 1)
+    versions = list(versions)
+    if SNAPSHOT:
+        movesets = []
+        for ver in versions:
+            try:
+                movesets.append((ver, _snapshot(ver).moves_from_pokemonid(
+                    pokemon_id)))
+            except IndexError:
+                pass
+        return movesets
+    query = """
+        SELECT pm.version_group_id, p.id, p.name,
+               pm.level, m.name
+        FROM pokemon p
+        JOIN pokemon_moves pm ON pm.pokemon_id = p.id
+        JOIN moves m ON pm.move_id = m.id
+        WHERE pm.version_group_id IN (%s)
+            AND p.id = ?
+            AND pm.pokemon_move_method_id = 1
+        ORDER BY pm.version_group_id, pm.level, pm."order"
+    """ % ", ".join("?" * len(versions))
+    cur = _query(query, versions + [pokemon_id])
+    movesets = {}
+    for (ver, id, name), group in itertools.groupby(cur, (lambda x: x[:3])):
+        movesets[ver] = ((id, name), [x[3:] for x in group])
+
+    return [(ver, movesets[ver]) for ver in versions if ver in movesets]
+
+
+def all_evids():
+    if SNAPSHOT:
+        return _pokedex().all_evids()
+    query = """
+        SELECT DISTINCT evolution_chain_id
+        FROM pokemon
+        ORDER BY evolution_chain_id
+    """
+    return [row[0] for row in _query(query)]
 
 def all_pokemon():
-    _connect()
+    if SNAPSHOT:
+        return _pokedex().all_pokemon()
     query = """\
     SELECT id, name FROM pokemon ORDER BY name;
     """
-    return _conn.execute(query)
+    return _query(query)
+
+
+class Pokedex(object):
+    """The names and evolutions of every pokemon, and the names of the moves"""
+
+    def __init__(self):
+        self.names = {}
+        self.evids = {}
+        self.parents = {}
+        self.chains = {} # evid -> [pokemon id]
+        query = """
+            SELECT p.id, p.name, p.evolution_chain_id,
+                   pe.from_pokemon_id as evparent
+            FROM pokemon p
+            LEFT OUTER JOIN pokemon_evolution pe ON pe.to_pokemon_id = p.id
+            ORDER BY p.id
+        """
+        for id, name, evid, evparent in _query(query):
+            if id in self.names:
+                continue
+            self.names[id] = name
+            self.evids[id] = evid
+            self.parents[id] = evparent
+            self.chains.setdefault(evid, []).append(id)
+        by_id = sorted(self.names.items())
+        self.by_name = sorted(by_id, key=lambda p: p[1])
+
+        query = "SELECT id, name FROM moves"
+        self.move_names = dict(_query(query))
+
+    def evid(self, pokemon_id):
+        return self.evids[pokemon_id]
+
+    def all_evids(self):
+        return sorted(self.chains)
+
+    def all_pokemon(self):
+        return list(self.by_name)
+
+class Snapshot(object):
+    """The level-up movesets of one version, loaded in a single scan
+
+    Each pokemon's moveset is kept as two arrays, of levels and of move ids.
+    """
+
+    def __init__(self, ver, pokedex):
+        self.pokedex = pokedex
+        self.movesets = {} # pokemon id -> (levels, move ids)
+        query = """
+            SELECT p.id, pm.level, m.id
+            FROM pokemon p
+            JOIN pokemon_moves pm ON pm.pokemon_id = p.id
+            JOIN moves m ON pm.move_id = m.id
+            WHERE pm.version_group_id = ?
+                AND pm.pokemon_move_method_id = 1
+            ORDER BY p.id, pm.level, pm."order"
+        """
+        cur = _query(query, [ver])
+        for id, group in itertools.groupby(cur, (lambda x: x[0])):
+            levels = array('H')
+            moves = array('H')
+            for _, level, move_id in group:
+                levels.append(level)
+                moves.append(move_id)
+            self.movesets[id] = levels, moves
+
+    def moveset(self, id):
+        names = self.pokedex.move_names
+        levels, moves = self.movesets[id]
+        return ((id, self.pokedex.names[id]),
+                [(level, names[move]) for level, move in zip(levels, moves)])
+
+    def moves_from_evid(self, evid):
+        members = [id for id in self.pokedex.chains.get(evid, ())
+                   if id in self.movesets]
+        parents = dict((id, self.pokedex.parents[id]) for id in members)
+        return _sort_stages([self.moveset(id) for id in members], parents)
+
+    def moves_from_pokemonid(self, pokemon_id):
+        if pokemon_id not in self.movesets:
+            raise IndexError("no moves for pokemon %r" % pokemon_id)
+        return self.moveset(pokemon_id)
+
+    def moves_from_pokemonids(self, pokemon_ids):
+        movesets = []
+        for id in pokemon_ids:
+            if id not in self.movesets:
+                raise KeyError(id)
+            movesets.append(self.moveset(id))
+        return movesets
+
+_pokedex_snapshot = None
+_snapshots = {} # version -> Snapshot
+_snapshot_file = None
+_snapshot_lock = threading.RLock()
+
+def _pokedex():
+    global _pokedex_snapshot
+    if _snapshot_file is not None:
+        return _snapshot_file
+    with _snapshot_lock:
+        if _pokedex_snapshot is None:
+            _pokedex_snapshot = Pokedex()
+        return _pokedex_snapshot
+
+def _snapshot(ver):
+    snapshot = _snapshots.get(ver)
+    if snapshot is None:
+        with _snapshot_lock:
+            snapshot = _snapshots.get(ver)
+            if snapshot is None:
+                if _snapshot_file is not None:
+                    snapshot = _snapshot_file.version(ver)
+                else:
+                    snapshot = Snapshot(ver, _pokedex())
+                _snapshots[ver] = snapshot
+    return snapshot
+
+
+# The snapshot file format. Everything is little-endian, and the records of
+# each table are sorted by their first field.
+#
+#   header      FILE_HEADER
+#   pokemon     POKEMON_RECORD for each pokemon
+#   by name     u16 index into pokemon for each pokemon, in order of name
+#   moves       MOVE_RECORD for each move id from 0 to the largest one
+#   chains      CHAIN_RECORD for each evolution chain
+#   members     u16 pokemon ids: the members of each chain, by id
+#   versions    VERSION_RECORD for each version
+#   movesets    MOVESET_RECORD for each pokemon with moves, by version
+#   moves data  u16 levels, then u16 move ids, for each moveset
+#   strings     the names, utf-8
+#
+# Names are given as (length, offset into strings). A pokemon's parent and
+# a missing move are 0; pokemon and moves are numbered from 1.
+FILE_MAGIC = b'PKSN'
+FILE_FORMAT = 1
+FILE_HEADER = struct.Struct('<4sHH10I') # magic, format, 0, then
+                                       # (count, offset) of pokemon, moves,
+                                       # chains and versions, the offset of
+                                       # by name and of strings
+POKEMON_RECORD = struct.Struct('<HHHHI') # id, evid, parent, name
+MOVE_RECORD = struct.Struct('<HI') # name
+CHAIN_RECORD = struct.Struct('<HHI') # evid, member count, first member
+VERSION_RECORD = struct.Struct('<HHI') # version, moveset count, offset
+MOVESET_RECORD = struct.Struct('<HHI') # pokemon id, move count, offset
+
+def export(filename=SNAPSHOT_FILE, versions=None):
+    """Write the data the lookups need to filename, for use_snapshot_file
+
+    versions defaults to every version up to LATEST_VERSION."""
+    if versions is None:
+        versions = range(1, LATEST_VERSION + 1)
+    pokedex = Pokedex()
+    snapshots = [(ver, Snapshot(ver, pokedex)) for ver in versions]
+
+    strings = bytearray()
+    string_offsets = {}
+    def string(s):
+        if s not in string_offsets:
+            data = s.encode('utf-8')
+            string_offsets[s] = len(data), len(strings)
+            strings.extend(data)
+        return string_offsets[s]
+
+    ids = sorted(pokedex.names)
+    index = dict((id, i) for i, id in enumerate(ids))
+    pokemon = b"".join(
+        POKEMON_RECORD.pack(id, pokedex.evids[id],
+                            pokedex.parents[id] or 0,
+                            *string(pokedex.names[id]))
+        for id in ids)
+    by_name = array('H', [index[id] for id, _ in pokedex.by_name])
+
+    move_count = max(pokedex.move_names) + 1 if pokedex.move_names else 0
+    moves = b"".join(
+        MOVE_RECORD.pack(*string(pokedex.move_names[id]))
+        if id in pokedex.move_names else MOVE_RECORD.pack(0, 0)
+        for id in range(move_count))
+
+    chains = []
+    members = array('H')
+    for evid in sorted(pokedex.chains):
+        chains.append(CHAIN_RECORD.pack(evid, len(pokedex.chains[evid]),
+                                        len(members)))
+        members.extend(pokedex.chains[evid])
+    chains = b"".join(chains)
+
+    offset = (FILE_HEADER.size + len(pokemon) + 2 * len(by_name) +
+              len(moves) + len(chains) + 2 * len(members))
+    version_table = offset
+    offset += VERSION_RECORD.size * len(snapshots)
+    version_records = []
+    movesets = []
+    for ver, snapshot in snapshots:
+        version_records.append(VERSION_RECORD.pack(ver, len(snapshot.movesets),
+                                            offset))
+        offset += MOVESET_RECORD.size * len(snapshot.movesets)
+    data = array('H')
+    for ver, snapshot in snapshots:
+        for id in sorted(snapshot.movesets):
+            levels, move_ids = snapshot.movesets[id]
+            movesets.append(MOVESET_RECORD.pack(
+                id, len(levels), offset + 2 * len(data)))
+            data.extend(levels)
+            data.extend(move_ids)
+    strings_offset = offset + 2 * len(data)
+
+    if sys.byteorder != 'little':
+        for a in by_name, members, data:
+            a.byteswap()
+
+    offset = FILE_HEADER.size
+    header = FILE_HEADER.pack(
+        FILE_MAGIC, FILE_FORMAT, 0,
+        len(ids), offset,
+        move_count, offset + len(pokemon) + 2 * len(by_name),
+        len(pokedex.chains),
+        offset + len(pokemon) + 2 * len(by_name) + len(moves),
+        len(snapshots), version_table,
+        offset + len(pokemon), strings_offset)
+    with open(filename + '.tmp', 'wb') as f:
+        for part in (header, pokemon, by_name, moves, chains, members,
+                     b"".join(version_records), b"".join(movesets), data,
+                     strings):
+            f.write(part)
+    os.replace(filename + '.tmp', filename)
+
+def use_snapshot_file(filename=SNAPSHOT_FILE):
+    """Answer the lookups from a file written by export().
+
+    Returns False, and leaves things as they were, if the file doesn't exist
+    or is older than DATABASE."""
+    global _snapshot_file, SNAPSHOT
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return False
+    try:
+        if mtime < os.path.getmtime(DATABASE):
+            return False
+    except OSError:
+        pass # the file is all there is
+    snapshot_file = SnapshotFile(filename)
+    with _snapshot_lock:
+        _snapshot_file = snapshot_file
+        _snapshots.clear()
+        SNAPSHOT = True
+    return True
+
+class SnapshotFile(object):
+    """A snapshot written by export(), mapped into memory
+
+    Nothing is read up front: each lookup finds its records by binary
+    search and decodes only those, so opening the file costs next to nothing
+    and processes using it share its pages.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self.map)
+        header = FILE_HEADER.unpack_from(self.buf, 0)
+        if header[0] != FILE_MAGIC or header[1] != FILE_FORMAT:
+            raise ValueError("%s is not a pokedex snapshot" % filename)
+        (self.pokemon_count, self.pokemon_offset,
+         self.move_count, self.move_offset,
+         self.chain_count, self.chain_offset,
+         self.version_count, self.version_offset,
+         self.by_name_offset, self.strings_offset) = header[3:]
+
+    def find(self, record, offset, count, key):
+        """The offset of the record whose first field is key, or None"""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = struct.unpack_from('<H', self.buf,
+                                       offset + mid * record.size)[0]
+            if value < key:
+                lo = mid + 1
+            elif key < value:
+                hi = mid
+            else:
+                return offset + mid * record.size
+        return None
+
+    def shorts(self, offset, count):
+        """count u16s from offset"""
+        if sys.byteorder == 'little':
+            return self.buf[offset:offset + 2 * count].cast('H')
+        return struct.unpack_from('<%dH' % count, self.buf, offset)
+
+    def string(self, length, offset):
+        offset += self.strings_offset
+        return str(self.buf[offset:offset + length], 'utf-8')
+
+    def pokemon(self, pokemon_id):
+        """(id, evid, parent, name length, name offset) for pokemon_id"""
+        offset = self.find(POKEMON_RECORD, self.pokemon_offset,
+                           self.pokemon_count, pokemon_id)
+        if offset is None:
+            raise KeyError(pokemon_id)
+        return POKEMON_RECORD.unpack_from(self.buf, offset)
+
+    def move_name(self, move_id):
+        return self.string(*MOVE_RECORD.unpack_from(
+            self.buf, self.move_offset + move_id * MOVE_RECORD.size))
+
+    def evid(self, pokemon_id):
+        return self.pokemon(pokemon_id)[1]
+
+    def all_evids(self):
+        return [CHAIN_RECORD.unpack_from(
+                    self.buf, self.chain_offset + i * CHAIN_RECORD.size)[0]
+                for i in range(self.chain_count)]
+
+    def all_pokemon(self):
+        pokemon = []
+        for i in self.shorts(self.by_name_offset, self.pokemon_count):
+            id, _, _, length, offset = POKEMON_RECORD.unpack_from(
+                self.buf, self.pokemon_offset + i * POKEMON_RECORD.size)
+            pokemon.append((id, self.string(length, offset)))
+        return pokemon
+
+    def chain(self, evid):
+        """The ids of the pokemon in the evolution chain evid"""
+        offset = self.find(CHAIN_RECORD, self.chain_offset,
+                           self.chain_count, evid)
+        if offset is None:
+            return ()
+        _, count, first = CHAIN_RECORD.unpack_from(self.buf, offset)
+        members = (self.chain_offset + self.chain_count * CHAIN_RECORD.size +
+                   2 * first)
+        return self.shorts(members, count)
+
+    def version(self, ver):
+        offset = self.find(VERSION_RECORD, self.version_offset,
+                           self.version_count, ver)
+        if offset is None:
+            return SnapshotFileVersion(self, 0, 0)
+        _, count, table = VERSION_RECORD.unpack_from(self.buf, offset)
+        return SnapshotFileVersion(self, table, count)
+
+class SnapshotFileVersion(object):
+    """The movesets of one version in a SnapshotFile, like Snapshot"""
+
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def has_moves(self, id):
+        return self.file.find(MOVESET_RECORD, self.offset, self.count,
+                              id) is not None
+
+    def moveset(self, id):
+        file = self.file
+        offset = file.find(MOVESET_RECORD, self.offset, self.count, id)
+        if offset is None:
+            raise KeyError(id)
+        _, count, data = MOVESET_RECORD.unpack_from(file.buf, offset)
+        levels = file.shorts(data, count)
+        moves = file.shorts(data + 2 * count, count)
+        _, _, _, length, name = file.pokemon(id)
+        return ((id, file.string(length, name)),
+                [(level, file.move_name(move))
+                 for level, move in zip(levels, moves)])
+
+    def moves_from_evid(self, evid):
+        members = [id for id in self.file.chain(evid) if self.has_moves(id)]
+        parents = dict((id, self.file.pokemon(id)[2] or None)
+                       for id in members)
+        return _sort_stages([self.moveset(id) for id in members], parents)
+
+    def moves_from_pokemonid(self, pokemon_id):
+        if not self.has_moves(pokemon_id):
+            raise IndexError("no moves for pokemon %r" % pokemon_id)
+        return self.moveset(pokemon_id)
 
+    def moves_from_pokemonids(self, pokemon_ids):
+        return [self.moveset(id) for id in pokemon_ids]
@@ -0,0 +1,181 @@
+"""
+staticsite.py - render every comparify page to plain files
+
+Everything the pages show comes from the pokedex, which hardly ever changes,
+so the whole site can be rendered ahead of time and served by any web server
+without running Python per request. build() writes
+
+    index.html                    the index page
+    <ver>/<id>.html, <id>.txt     the family page for each pokemon
+    <ver>/<id>-<id>-...html, txt  the quicklinks
+
+where <ver> is a key of comparify_web.version_map, .html is what
+fmt_html renders and .txt is what fmt_plaintext renders. The links
+between pages point at these files. The forms on the index page still submit
+a query string; to keep the single pokemon form working, the server can map
+?pokemon_id=N (and &ver=V) onto <ver>/N.html.
+
+manifest.json in the output directory records a fingerprint of the inputs
+of each file: the movesets it was rendered from and the source of the
+modules that render it. Pages whose fingerprint hasn't changed since the
+last build are not rendered again, and files which are no longer part of
+the site are removed.
+
+Functions:
+    pages - every page of the site, with the movesets it shows
+    build - render the pages which have changed, in a pool of processes
+"""
+
+import os
+import json
+import hashlib
+
+import comparify
+import comparify_web
+import pokemon
+
+MANIFEST = 'manifest.json'
+
+def source_stamp():
+    """A digest of the code the pages are rendered with"""
+    digest = hashlib.sha1()
+    for module in (comparify, comparify_web, pokemon):
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def fingerprint(stamp, name, cache_key, moves):
+    data = json.dumps([stamp, name, cache_key, moves])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def page_name(pokemon_ids):
+    return "-".join(map(str, pokemon_ids))
+
+def pages():
+    """Yield (ver name, subject, moves, current ids) for every page.
+
+    subject and moves are as returned by comparify_web.load_compare. For a
+    family, current ids are the ids of the pokemon in it, each of which gets
+    its own page; for a quicklink it is None."""
+    versions = sorted(comparify_web.version_map.items(), key=lambda x: x[1])
+    for name, ver in versions:
+        for evid in pokemon.all_evids():
+            moves = pokemon.moves_from_evid(evid, ver)
+            if not moves:
+                continue
+            ids = [id for (id, _), _ in moves]
+            yield name, (('evid', evid), ver), moves, ids
+
+        for ids, label in comparify_web.quicklinks:
+            try:
+                moves = pokemon.moves_from_pokemonids(ids, ver)
+            except KeyError:
+                # not every one of them is in this version
+                continue
+            yield name, (('pokemon', ids), ver), moves, None
+
+def _render(outdir, name, moves, current_ids, cache_key):
+    """Render the files for one entry of pages(), returning their paths"""
+    written = []
+    def write(path, text):
+        filename = os.path.join(outdir, path)
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(filename + '.tmp', filename)
+        written.append(path)
+
+    # the pages of each version are in a directory of their own, so the
+    # links stay in it. The pages are aligned afresh rather than through
+    # aligncache: the manifest already decides what needs rendering, and
+    # the workers shouldn't all be writing to the cache.
+    url = lambda ids, ver=None: page_name(ids) + ".html"
+    text = comparify_web.fmt_plaintext(moves)
+    if current_ids is None:
+        (_, ids), _ = cache_key
+        path = os.path.join(name, page_name(ids))
+        write(path + ".html", comparify_web.fmt_html(moves, None, url=url))
+        write(path + ".txt", text)
+    else:
+        for id in current_ids:
+            path = os.path.join(name, str(id))
+            write(path + ".html", comparify_web.fmt_html(moves, id, url=url))
+            write(path + ".txt", text)
+    return written
+
+def _paths(name, cache_key, current_ids):
+    if current_ids is None:
+        (_, ids), _ = cache_key
+        current_ids = [page_name(ids)]
+    return [os.path.join(name, str(id)) + ext
+            for id in current_ids for ext in (".html", ".txt")]
+
+def build(outdir, workers=None, force=False):
+    """Render the site into outdir, skipping pages which haven't changed.
+
+    Yields the path of each file as it is written. If force is true every
+    page is rendered again."""
+    from concurrent import futures
+
+    manifest_file = os.path.join(outdir, MANIFEST)
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+    if force:
+        manifest = {}
+
+    stamp = source_stamp()
+    latest = [name for name, ver in comparify_web.version_map.items()
+              if ver == pokemon.LATEST_VERSION][0]
+    new_manifest = {}
+
+    executor = futures.ProcessPoolExecutor(workers)
+    try:
+        pending = {}
+        for name, cache_key, moves, current_ids in pages():
+            if not os.path.isdir(os.path.join(outdir, name)):
+                os.makedirs(os.path.join(outdir, name))
+            fp = fingerprint(stamp, name, cache_key, moves)
+            paths = _paths(name, cache_key, current_ids)
+            for path in paths:
+                new_manifest[path] = fp
+            if all(manifest.get(path) == fp and
+                   os.path.exists(os.path.join(outdir, path))
+                   for path in paths):
+                continue
+            future = executor.submit(_render, outdir, name, moves,
+                                     current_ids, cache_key)
+            pending[future] = paths
+
+        index = comparify_web.fmt_index(
+            lambda ids: os.path.join(latest, page_name(ids) + ".html"))
+        with open(os.path.join(outdir, 'index.html'), 'w',
+                  encoding='utf-8') as f:
+            f.write(index)
+        yield 'index.html'
+
+        try:
+            for future in futures.as_completed(pending):
+                for path in future.result():
+                    yield path
+        except BaseException:
+            # the pages which weren't written will have to be next time
+            for future, paths in pending.items():
+                if (not future.done() or future.cancelled() or
+                        future.exception() is not None):
+                    for path in paths:
+                        new_manifest.pop(path, None)
+            raise
+        else:
+            for path in set(manifest) - set(new_manifest):
+                try:
+                    os.remove(os.path.join(outdir, path))
+                except OSError:
+                    pass
+        finally:
+            with open(manifest_file + '.tmp', 'w') as f:
+                json.dump(new_manifest, f, indent=0, sort_keys=True)
+            os.replace(manifest_file + '.tmp', manifest_file)
+    finally:
+        executor.shutdown()
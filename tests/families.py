@@ -0,0 +1,56 @@
+"""Movesets for the tests which compare two ways of aligning"""
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pokemon
+
+MOVES = ['Move%d' % i for i in range(60)]
+
+def family(r):
+    """A base moveset and a few evolutions of it, each with moves dropped,
+    swapped, added and moved to later levels"""
+    base = []
+    level = 1
+    for k in range(r.randint(4, 20)):
+        if 1 < k and r.random() < 0.8:
+            level += r.randint(0, 7)
+        base.append((level, r.choice(MOVES)))
+    movesets = [base]
+    for _ in range(r.randint(1, 3)):
+        shift = r.choice([0, 0, 1, 2, 5])
+        moveset = []
+        for level, move in movesets[-1]:
+            x = r.random()
+            if x < 0.1:
+                continue
+            if x < 0.2:
+                move = r.choice(MOVES)
+            if 1 < level:
+                level += shift * (level // 10)
+            moveset.append((level, move))
+            if r.random() < 0.08:
+                moveset.append((level + r.randint(0, 3), r.choice(MOVES)))
+        if r.random() < 0.5:
+            moveset = [(1, m) for _, m in base[:r.randint(0, 4)]] + moveset
+        moveset.sort(key=lambda x: x[0])
+        movesets.append(moveset)
+    return movesets
+
+def generated(count=150, seed=0):
+    r = random.Random(seed)
+    return [family(r) for _ in range(count)]
+
+def corpus():
+    """The generated families, and every family in the pokedex if there
+    is one"""
+    families = generated()
+    if os.path.exists(pokemon.DATABASE):
+        for evid in pokemon.all_evids():
+            moves = pokemon.moves_from_evid(evid, pokemon.LATEST_VERSION)
+            if moves:
+                families.append([moveset for _, moveset in moves])
+    return families
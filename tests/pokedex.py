@@ -0,0 +1,80 @@
+"""A small generated pokedex, for the tests which need a database"""
+
+import os
+import sys
+import random
+import sqlite3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pokemon
+from families import MOVES, family
+
+SCHEMA = """
+    CREATE TABLE pokemon (id INTEGER PRIMARY KEY, name TEXT,
+                          evolution_chain_id INTEGER);
+    CREATE TABLE pokemon_evolution (from_pokemon_id INTEGER,
+                                    to_pokemon_id INTEGER);
+    CREATE TABLE moves (id INTEGER PRIMARY KEY, name TEXT);
+    CREATE TABLE pokemon_moves (pokemon_id INTEGER, version_group_id INTEGER,
+                                move_id INTEGER,
+                                pokemon_move_method_id INTEGER,
+                                level INTEGER, "order" INTEGER);
+"""
+
+def move_id(name):
+    # leave gaps in the move ids
+    return 2 * MOVES.index(name) + 1
+
+def make_database(path, chains=40, seed=0):
+    """Write a pokedex of chains evolution chains to path.
+
+    Some chains only appear in later versions, and the first member of some
+    only in a later version than the rest, like a baby pokemon. The last
+    pokemon has no moves at all. Every level-up move also has a tutor move
+    next to it, which the lookups must leave out."""
+    r = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.executemany("INSERT INTO moves VALUES (?, ?)",
+                     [(move_id(name), name) for name in MOVES])
+    id = 0
+    for evid in range(1, chains + 1):
+        ids = []
+        for k in range(r.randint(1, 3)):
+            id += 1
+            name = r.choice(["Poke%d", "Pok\xe9%d", "Nidoran♀%d"]) % id
+            conn.execute("INSERT INTO pokemon VALUES (?, ?, ?)",
+                         [id, name, evid])
+            if ids:
+                conn.execute("INSERT INTO pokemon_evolution VALUES (?, ?)",
+                             [ids[-1], id])
+            ids.append(id)
+        intro = r.choice([1, 1, 1, 3, 5, 9])
+        baby = r.choice([intro, intro, intro + 2])
+        for ver in range(intro, pokemon.LATEST_VERSION + 1):
+            movesets = family(r)
+            for k, id in enumerate(ids):
+                if k == 0 and ver < baby:
+                    continue
+                moveset = movesets[min(k, len(movesets) - 1)]
+                for order, (level, name) in enumerate(moveset):
+                    for method in (1, 3):
+                        conn.execute("""
+                            INSERT INTO pokemon_moves VALUES (?, ?, ?, ?, ?, ?)
+                        """, [id, ver, move_id(name), method, level, order])
+    id += 1
+    conn.execute("INSERT INTO pokemon VALUES (?, ?, ?)",
+                 [id, "Missingno", chains + 1])
+    conn.commit()
+    conn.close()
+    return id
+
+def use_database(path):
+    """Point pokemon at path, forgetting everything it has loaded"""
+    pokemon.DATABASE = path
+    pokemon.SNAPSHOT = False
+    pokemon._pool = None
+    pokemon._pokedex_snapshot = None
+    pokemon._snapshot_file = None
+    pokemon._snapshots.clear()
@@ -0,0 +1,54 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aligncache
+import comparify
+
+MOVESETS = [[(1, 'Tackle'), (5, 'Growl'), (9, 'Bite')],
+            [(1, 'Tackle'), (9, 'Bite'), (20, 'Crunch')]]
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = aligncache.DATABASE, aligncache._code_stamp
+        aligncache.DATABASE = os.path.join(self.dir, 'alignments.sqlite')
+        aligncache._local = threading.local()
+
+    def tearDown(self):
+        aligncache.DATABASE, aligncache._code_stamp = self.saved
+        aligncache._local = threading.local()
+        shutil.rmtree(self.dir)
+
+    def align(self):
+        return aligncache.time_align(('evid', 1), 1, MOVESETS)[1]
+
+    def test_hit(self):
+        expected = comparify.align(MOVESETS)
+        self.assertEqual(self.align(), expected)
+        key = aligncache.make_key(('evid', 1), 1,
+                                  comparify.HeuristicMoveAligner)
+        fp = aligncache.fingerprint(MOVESETS)
+        self.assertEqual(aligncache.lookup(key, fp)[1], expected)
+
+    def test_code_change(self):
+        self.align()
+        key = aligncache.make_key(('evid', 1), 1,
+                                  comparify.HeuristicMoveAligner)
+        aligncache._code_stamp = 'changed'
+        self.assertIsNone(aligncache.lookup(key,
+                                            aligncache.fingerprint(MOVESETS)))
+
+    def test_unwritable(self):
+        aligncache.DATABASE = os.path.join(self.dir, 'missing', 'a.sqlite')
+        self.assertEqual(self.align(), comparify.align(MOVESETS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comparify
+from families import corpus
+
+
+class BandedTest(unittest.TestCase):
+    """The banded mode has to give the same tables as the full matrix"""
+
+    def check(self, aligner_class):
+        families = corpus()
+        full = [comparify.align(movesets, aligner_class)
+                for movesets in families]
+        try:
+            for band in (0, 1, 2):
+                aligner_class.band = band
+                for movesets, expected in zip(families, full):
+                    self.assertEqual(comparify.align(movesets, aligner_class),
+                                     expected, (band, movesets))
+        finally:
+            aligner_class.band = None
+
+    def test_needleman_wunsch(self):
+        self.check(comparify.NeedlemanWunschMoveAligner)
+
+    def test_dtw(self):
+        self.check(comparify.DTWMoveAligner)
+
+
+if __name__ == '__main__':
+    unittest.main()
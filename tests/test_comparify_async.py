@@ -0,0 +1,98 @@
+import io
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comparify_async
+
+
+class PageTest(unittest.TestCase):
+    def server(self):
+        server = comparify_async.Server(db_workers=1, align_workers=1)
+        self.renders = 0
+        async def render(query, accept):
+            self.renders += 1
+            await asyncio.sleep(0.05)
+            return "text/plain", query
+        server.render = render
+        return server
+
+    def test_shared(self):
+        server = self.server()
+        async def main():
+            return await asyncio.gather(server.page("a", ""),
+                                        server.page("a", ""))
+        pages = asyncio.run(main())
+        self.assertEqual(pages, [("text/plain", "a")] * 2)
+        self.assertEqual(self.renders, 1)
+        self.assertEqual(server.inflight, {})
+
+    def test_request_after_last_waiter_hangs_up(self):
+        server = self.server()
+        async def main():
+            a = asyncio.ensure_future(server.page("a", ""))
+            await asyncio.sleep(0)
+            a.cancel()
+            try:
+                await a
+            except asyncio.CancelledError:
+                pass
+            # no yield between the cancel and the next request
+            return await server.page("a", "")
+        self.assertEqual(asyncio.run(main()), ("text/plain", "a"))
+        self.assertEqual(self.renders, 2)
+
+
+class HandleTest(unittest.TestCase):
+    def get(self, server, query):
+        async def main():
+            listener = await asyncio.start_server(server.handle,
+                                                  '127.0.0.1', 0)
+            port = listener.sockets[0].getsockname()[1]
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1',
+                                                               port)
+                writer.write(("GET /?%s HTTP/1.1\r\n\r\n" % query)
+                             .encode('latin-1'))
+                response = await reader.read()
+                writer.close()
+                return response
+            finally:
+                listener.close()
+        head, _, body = asyncio.run(main()).partition(b"\r\n\r\n")
+        return head.split(b"\r\n")[0], body
+
+    def test_bad_request(self):
+        server = comparify_async.Server(db_workers=1, align_workers=1)
+        for query in ("pokemon_id=abc", "pokemon_id=1&ver=nope"):
+            status, body = self.get(server, query)
+            self.assertEqual(status, b"HTTP/1.1 400 Bad Request")
+
+    def test_not_found(self):
+        server = comparify_async.Server(db_workers=1, align_workers=1)
+        async def render(query, accept):
+            raise KeyError(9999)
+        server.render = render
+        status, body = self.get(server, "pokemon_id=9999")
+        self.assertEqual(status, b"HTTP/1.1 404 Not Found")
+
+    def test_error_is_not_sent(self):
+        server = comparify_async.Server(db_workers=1, align_workers=1)
+        async def render(query, accept):
+            raise RuntimeError("secret")
+        server.render = render
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            status, body = self.get(server, "pokemon_id=1")
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(status, b"HTTP/1.1 500 Internal Server Error")
+        self.assertNotIn(b"secret", body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from wsgiref.util import setup_testing_defaults
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comparify_web
+import pokemon
+from pokedex import make_database, use_database
+
+
+class ApplicationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.saved = pokemon.DATABASE
+        cls.last = make_database(os.path.join(cls.dir, 'pokedex.sqlite'))
+        use_database(os.path.join(cls.dir, 'pokedex.sqlite'))
+
+    @classmethod
+    def tearDownClass(cls):
+        use_database(cls.saved)
+        shutil.rmtree(cls.dir)
+
+    def get(self, query):
+        environ = {'QUERY_STRING': query}
+        setup_testing_defaults(environ)
+        response = []
+        def start_response(status, headers):
+            response.append(status)
+        body = b"".join(comparify_web.application(environ, start_response))
+        return response[0], body.decode('utf-8')
+
+    def test_page(self):
+        status, body = self.get("pokemon_id=1")
+        self.assertEqual(status, "200 OK")
+        self.assertIn(pokemon.moves_from_pokemonid(1)[0][1], body)
+
+    def test_bad_request(self):
+        for query in ("pokemon_id=abc", "pokemon_id=1&ver=zz"):
+            self.assertEqual(self.get(query)[0], "400 Bad Request", query)
+
+    def test_not_found(self):
+        for query in ("pokemon_id=9999", "pokemon_id=9999&pokemon_id=1",
+                      "pokemon_id=9999&ver=all", "pokemon_id=%d" % self.last,
+                      "pokemon_id=%d&ver=all" % self.last):
+            self.assertEqual(self.get(query)[0], "404 Not Found", query)
+
+
+if __name__ == '__main__':
+    unittest.main()
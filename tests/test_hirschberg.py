@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comparify
+from families import corpus
+
+
+def variant(aligner_class, **settings):
+    return type(aligner_class.__name__, (aligner_class,), settings)
+
+
+class HirschbergTest(unittest.TestCase):
+    """The divide-and-conquer mode has to give the same tables as the full
+    matrix, down to which of equally good alignments it picks"""
+
+    def check(self, aligner_class, align):
+        families = corpus()
+        full = variant(aligner_class, use_numpy=False,
+                       hirschberg_threshold=None)
+        expected = [align(movesets, full) for movesets in families]
+        for block in (1, 2, 7, 64):
+            split = variant(aligner_class, hirschberg_threshold=0,
+                            hirschberg_block=block)
+            for movesets, table in zip(families, expected):
+                self.assertEqual(align(movesets, split), table,
+                                 (block, movesets))
+
+    def test_engine(self):
+        aligner_class = variant(comparify.NeedlemanWunschMoveAligner,
+                                hirschberg_threshold=0)
+        moveset = comparify.encode([(1, 'Tackle'), (5, 'Growl')])
+        aligner = aligner_class(comparify.Table.from_moveset(moveset),
+                                moveset)
+        self.assertEqual(aligner.choose_engine(), 'hirschberg')
+
+    def test_needleman_wunsch(self):
+        self.check(comparify.NeedlemanWunschMoveAligner, comparify.align)
+
+    def test_profile(self):
+        self.check(comparify.ProfileMoveAligner, comparify.align_tree)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comparify
+from families import family
+
+
+class MemoTest(unittest.TestCase):
+    """Tables from the memo have to be the same as aligning afresh, and
+    the tables in it must not change when later alignments build on them"""
+
+    def families(self):
+        r = random.Random(0)
+        families = [family(r) for _ in range(40)]
+        # which start (and end) the same way as each other
+        return families + [f[:2] + g for f, g in zip(families, families[1:])]
+
+    def check(self, aligner_class):
+        memo = comparify.AlignmentMemo()
+        for movesets in self.families():
+            before = [(key, table.rows())
+                      for key, table in memo.entries.items()]
+            self.assertEqual(comparify.align(movesets, aligner_class,
+                                             memo=memo),
+                             comparify.align(movesets, aligner_class))
+            for key, rows in before:
+                if key in memo.entries:
+                    self.assertEqual(memo.entries[key].rows(), rows)
+        self.assertTrue(memo.hits)
+
+    def test_ltr(self):
+        self.check(comparify.HeuristicMoveAligner)
+
+    def test_rtl(self):
+        self.check(comparify.HeuristicMoveAlignerRTL)
+
+    def test_needleman_wunsch(self):
+        self.check(comparify.NeedlemanWunschMoveAligner)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comparify
+from families import corpus
+
+
+def variant(aligner_class, **settings):
+    return type(aligner_class.__name__, (aligner_class,), settings)
+
+
+@unittest.skipIf(comparify.numpy is None, "numpy is not installed")
+class NumpyTest(unittest.TestCase):
+    """The numpy engine has to give the same tables as the python one"""
+
+    gap_penalties = [(0, 0, 1), (0, 0, 0), (0, 0, -1), (0, -1, 0),
+                     (-1, 0, 0), (0, 2, -3), (1, -1, 1)]
+
+    def check(self, aligner_class, align):
+        families = corpus()
+        for gap in self.gap_penalties:
+            python = variant(aligner_class, gap_penalty=gap, use_numpy=False)
+            vectorized = variant(aligner_class, gap_penalty=gap, use_numpy=True)
+            for movesets in families:
+                self.assertEqual(align(movesets, vectorized),
+                                 align(movesets, python), (gap, movesets))
+
+    def test_needleman_wunsch(self):
+        self.check(comparify.NeedlemanWunschMoveAligner, comparify.align)
+
+    def test_profile(self):
+        self.check(comparify.ProfileMoveAligner, comparify.align_tree)
+
+
+if __name__ == '__main__':
+    unittest.main()
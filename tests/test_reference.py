@@ -0,0 +1,56 @@
+"""
+The aligners have to give the tables they gave before their passes were
+rewritten for speed.
+
+reference_tables.json holds, for each aligner, the sha1 of the JSON of the
+table the original implementation gave for each of families.generated().
+"""
+import os
+import sys
+import json
+import hashlib
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comparify
+from families import generated
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'reference_tables.json')
+
+def digest(table):
+    return hashlib.sha1(json.dumps(table).encode('utf-8')).hexdigest()
+
+
+class ReferenceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(REFERENCE) as f:
+            cls.reference = json.load(f)
+        cls.families = generated()
+
+    def check(self, aligner_class):
+        expected = self.reference[aligner_class.__name__]
+        self.assertEqual(len(expected), len(self.families))
+        for movesets, table in zip(self.families, expected):
+            self.assertEqual(digest(comparify.align(movesets, aligner_class)),
+                             table, movesets)
+
+    def test_heuristic(self):
+        self.check(comparify.HeuristicMoveAligner)
+
+    def test_heuristic_rtl(self):
+        self.check(comparify.HeuristicMoveAlignerRTL)
+
+    # these only share the post-processing with the heuristic aligners
+
+    def test_needleman_wunsch(self):
+        self.check(comparify.NeedlemanWunschMoveAligner)
+
+    def test_dtw(self):
+        self.check(comparify.DTWMoveAligner)
+
+
+if __name__ == '__main__':
+    unittest.main()
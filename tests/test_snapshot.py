@@ -0,0 +1,116 @@
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pokemon
+from pokedex import make_database, use_database
+
+
+class SnapshotTest(unittest.TestCase):
+    """SNAPSHOT and a snapshot file have to answer every lookup the way
+    the queries do"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.saved = pokemon.DATABASE
+        cls.database = os.path.join(cls.dir, 'pokedex.sqlite')
+        cls.snapshot_file = os.path.join(cls.dir, 'pokedex.snapshot')
+        cls.last = make_database(cls.database)
+        use_database(cls.database)
+        cls.expected = cls.lookups()
+        pokemon.export(cls.snapshot_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        use_database(cls.saved)
+        shutil.rmtree(cls.dir)
+
+    def tearDown(self):
+        use_database(self.database)
+
+    @classmethod
+    def lookups(cls):
+        """The answer to every lookup, or the kind of error it raised"""
+        def call(f, *args):
+            try:
+                return f(*args)
+            except LookupError:
+                return LookupError
+        ids = range(0, cls.last + 2)
+        versions = range(1, pokemon.LATEST_VERSION + 1)
+        evids = pokemon.all_evids()
+        found = {
+            'all_evids': list(evids),
+            'all_pokemon': [tuple(p) for p in pokemon.all_pokemon()],
+            'evid': [call(pokemon.evid_from_pokemonid, id) for id in ids],
+        }
+        for ver in versions:
+            found['evid', ver] = [call(pokemon.moves_from_evid, evid, ver)
+                                  for evid in list(evids) + [0, 999]]
+            found['pokemon', ver] = [call(pokemon.moves_from_pokemonid,
+                                          id, ver) for id in ids]
+            found['pokemonids', ver] = [
+                call(pokemon.moves_from_pokemonids, [id, id + 1, 1], ver)
+                for id in ids]
+        found['versions'] = [pokemon.moves_across_versions(id) for id in ids]
+        found['some versions'] = [pokemon.moves_across_versions(id, [9, 2])
+                                  for id in ids]
+        return found
+
+    def check(self):
+        found = self.lookups()
+        self.assertEqual(sorted(found, key=str),
+                         sorted(self.expected, key=str))
+        for key in self.expected:
+            self.assertEqual(found[key], self.expected[key], key)
+
+    def test_generated(self):
+        # the lookups have to cover the odd cases
+        evid = self.expected['evid']
+        self.assertIn(LookupError, evid)
+        self.assertIn(LookupError, self.expected['pokemon', 1])
+        self.assertIn([], self.expected['evid', 1])
+        self.assertTrue(any('\xe9' in name
+                            for _, name in self.expected['all_pokemon']))
+
+    def test_snapshot(self):
+        pokemon.SNAPSHOT = True
+        self.check()
+
+    def test_snapshot_file(self):
+        self.assertTrue(pokemon.use_snapshot_file(self.snapshot_file))
+        self.assertIsInstance(pokemon._pokedex(), pokemon.SnapshotFile)
+        self.check()
+
+    def test_snapshot_file_big_endian(self):
+        # the file is little-endian whatever the machine; read it the way
+        # a big-endian one does
+        saved = pokemon.sys
+        pokemon.sys = types.SimpleNamespace(byteorder='big')
+        try:
+            self.assertTrue(pokemon.use_snapshot_file(self.snapshot_file))
+            self.check()
+        finally:
+            pokemon.sys = saved
+
+    def test_stale_snapshot_file(self):
+        mtime = os.path.getmtime(self.database)
+        os.utime(self.snapshot_file, (mtime - 10, mtime - 10))
+        try:
+            self.assertFalse(pokemon.use_snapshot_file(self.snapshot_file))
+        finally:
+            os.utime(self.snapshot_file, None)
+
+    def test_not_a_snapshot(self):
+        with self.assertRaises(ValueError):
+            pokemon.SnapshotFile(self.database)
+
+
+if __name__ == '__main__':
+    unittest.main()